@@ -343,12 +343,11 @@ AbsolutePath findImportHelperPath() {
   }
 }
 
-/**
- * Get the path to the hg_import_helper.py script.
- *
- * This function is thread-safe and caches the result once we have found
- * the  helper script once.
- */
+} // unnamed namespace
+
+namespace facebook {
+namespace eden {
+
 AbsolutePath getImportHelperPath() {
   // C++11 guarantees that this static initialization will be thread-safe, and
   // if findImportHelperPath() throws it will retry initialization the next
@@ -357,11 +356,6 @@ AbsolutePath getImportHelperPath() {
   return helperPath;
 }
 
-} // unnamed namespace
-
-namespace facebook {
-namespace eden {
-
 HgImporter::HgImporter(AbsolutePathPiece repoPath, LocalStore* store)
     : repoPath_{repoPath}, store_{store} {
   auto importHelper = getImportHelperPath();
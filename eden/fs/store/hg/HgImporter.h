@@ -34,6 +34,14 @@ class HgManifestImporter;
 class StoreResult;
 class Tree;
 
+/**
+ * Get the path to the hg_import_helper.py script.
+ *
+ * This function is thread-safe and caches the result once we have found
+ * the  helper script once.
+ */
+AbsolutePath getImportHelperPath();
+
 /**
  * HgImporter provides an API for extracting data out of a mercurial
  * repository.
@@ -137,6 +145,10 @@ class HgImporter {
   enum : uint32_t {
     FLAG_ERROR = 0x01,
     FLAG_MORE_CHUNKS = 0x02,
+    FLAG_ZLIB_COMPRESSED = 0x04,
+    FLAG_STREAM_RESPONSE = 0x08,
+    FLAG_COMPACT_MANIFEST = 0x10,
+    FLAG_PREFETCH_PRIORITY = 0x20,
   };
   /**
    * hg_import_helper protocol version number.
@@ -149,13 +161,16 @@ class HgImporter {
    * hg_import_helper.py
    */
   enum : uint32_t {
-    PROTOCOL_VERSION = 1,
+    PROTOCOL_VERSION = 19,
   };
   /**
    * Flags for the CMD_STARTED response
    */
   enum StartFlag : uint32_t {
     TREEMANIFEST_SUPPORTED = 0x01,
+    CONCURRENT_RESPONSES = 0x02,
+    ZLIB_SUPPORTED = 0x04,
+    COMPACT_MANIFEST_SUPPORTED = 0x08,
   };
   /**
    * Command type values.
@@ -170,6 +185,19 @@ class HgImporter {
     CMD_CAT_FILE = 3,
     CMD_MANIFEST_NODE_FOR_COMMIT = 4,
     CMD_FETCH_TREE = 5,
+    CMD_CAT_FILE_BATCH = 6,
+    CMD_CACHE_STATS = 7,
+    CMD_MANIFEST_DIFF = 8,
+    CMD_FETCH_TREE_DEPTH = 9,
+    CMD_PREFETCH = 10,
+    CMD_STATS = 11,
+    CMD_FILE_METADATA = 12,
+    CMD_MANIFEST_NODES_FOR_COMMITS = 13,
+    CMD_MANIFEST_ENTRIES = 14,
+    CMD_CANCEL = 15,
+    CMD_CAT_FILE_DELTA = 16,
+    CMD_FETCH_TREES = 17,
+    CMD_GET_TREE = 18,
   };
   struct ChunkHeader {
     uint32_t requestID;
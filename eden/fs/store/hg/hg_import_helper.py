@@ -14,16 +14,34 @@ from __future__ import unicode_literals
 
 import argparse
 import binascii
+import bisect
 import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import inspect
 import logging
+import math
+import mmap
 import os
+import re
+import signal
+import socket
 import struct
 import sys
+import tempfile
+import threading
 import time
+import zlib
 
 import mercurial.error
 import mercurial.hg
+import mercurial.match
+import mercurial.mdiff
 import mercurial.node
+import mercurial.revlog
 import mercurial.scmutil
 import mercurial.txnutil
 import mercurial.util
@@ -38,6 +56,104 @@ try:
 except ImportError:
     from remotefilelog import shallowutil, constants
 
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_char_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+def _load_writev():
+    '''
+    Return a function that calls writev(2), taking a file descriptor and a
+    list of byte strings and returning the number of bytes written.
+
+    Python 3 provides os.writev(), but python 2 does not, so we call the C
+    library version through ctypes there.  Returns None if neither is
+    available.
+    '''
+    if hasattr(os, 'writev'):
+        return os.writev
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_writev = libc.writev
+    except (OSError, AttributeError):
+        return None
+    libc_writev.argtypes = [ctypes.c_int, ctypes.POINTER(_IOVec), ctypes.c_int]
+    libc_writev.restype = ctypes.c_ssize_t
+
+    def writev(fd, buffers):
+        # c_char_p points directly at the string data, so this does not
+        # copy the buffers.
+        iov = (_IOVec * len(buffers))(*[(buf, len(buf)) for buf in buffers])
+        result = libc_writev(fd, iov, len(buffers))
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+    return writev
+
+
+_writev = _load_writev()
+
+
+def read_exact(fd, length):
+    '''
+    Read exactly length bytes from the specified file descriptor.
+
+    Fewer bytes are returned only if EOF is reached first.
+    '''
+    parts = []
+    remaining = length
+    while remaining > 0:
+        try:
+            data = os.read(fd, remaining)
+        except OSError as ex:
+            if ex.errno == errno.EINTR:
+                continue
+            raise
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+def write_all(fd, buffers):
+    '''
+    Write all of the given byte strings to the specified file descriptor,
+    using a single writev() call in the common case.
+    '''
+    total_len = sum(len(buf) for buf in buffers)
+    written = 0
+    if _writev is not None:
+        while True:
+            try:
+                written = _writev(fd, buffers)
+                break
+            except OSError as ex:
+                if ex.errno != errno.EINTR:
+                    raise
+        if written == total_len:
+            return
+
+    # Handle a short write by writing out whatever remains of each buffer.
+    for buf in buffers:
+        if written >= len(buf):
+            written -= len(buf)
+            continue
+        view = memoryview(buf)[written:]
+        written = 0
+        while len(view) > 0:
+            try:
+                view = view[os.write(fd, view):]
+            except OSError as ex:
+                if ex.errno != errno.EINTR:
+                    raise
+
 #
 # Message chunk header format.
 # (This is a format argument for struct.unpack())
@@ -47,9 +163,13 @@ except ImportError:
 # - Transaction ID
 #   This is a numeric identifier used for associating a response with a given
 #   request.  The response for a particular request will always contain the
-#   same transaction ID as was sent in the request.  (Currently responses are
+#   same transaction ID as was sent in the request.  By default responses are
 #   always sent in the same order that requests were received, so this is
-#   primarily used just as a sanity check.)
+#   primarily used just as a sanity check.  When the helper is started with
+#   --workers, requests are processed concurrently and responses are sent in
+#   completion order.  In that mode chunks belonging to different
+#   transactions may be interleaved, and the transaction ID must be used to
+#   associate each chunk with its request.
 #
 # - Command ID
 #   This is one of the CMD_* constants below.
@@ -66,6 +186,8 @@ HEADER_SIZE = 16
 
 # The length of a SHA-1 hash
 SHA1_NUM_BYTES = 20
+# Matches a full hexadecimal SHA-1 hash
+HEX_HASH_RE = re.compile(br'^[0-9a-fA-F]{40}$')
 
 # The protocol version number.
 #
@@ -81,9 +203,18 @@ SHA1_NUM_BYTES = 20
 #
 # This must be kept in sync with the PROTOCOL_VERSION field in the C++
 # HgImporter code.
-PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 19
 
 START_FLAGS_TREEMANIFEST_SUPPORTED = 0x01
+# Responses may be sent out of order, and chunks for different transactions
+# may be interleaved.  This is set when the helper was started with --workers.
+START_FLAGS_CONCURRENT_RESPONSES = 0x02
+# The helper can send zlib-compressed response chunks.
+# See FLAG_ZLIB_COMPRESSED below.
+START_FLAGS_ZLIB_SUPPORTED = 0x04
+# The helper can send manifests in the compact encoding.
+# See FLAG_COMPACT_MANIFEST below.
+START_FLAGS_COMPACT_MANIFEST_SUPPORTED = 0x08
 
 #
 # Message types.
@@ -97,6 +228,19 @@ CMD_MANIFEST = 2
 CMD_CAT_FILE = 3
 CMD_MANIFEST_NODE_FOR_COMMIT = 4
 CMD_FETCH_TREE = 5
+CMD_CAT_FILE_BATCH = 6
+CMD_CACHE_STATS = 7
+CMD_MANIFEST_DIFF = 8
+CMD_FETCH_TREE_DEPTH = 9
+CMD_PREFETCH = 10
+CMD_STATS = 11
+CMD_FILE_METADATA = 12
+CMD_MANIFEST_NODES_FOR_COMMITS = 13
+CMD_MANIFEST_ENTRIES = 14
+CMD_CANCEL = 15
+CMD_CAT_FILE_DELTA = 16
+CMD_FETCH_TREES = 17
+CMD_GET_TREE = 18
 
 #
 # Flag values.
@@ -114,6 +258,134 @@ FLAG_ERROR = 0x01
 #   same request/response.  If this flag is not set, this is the final chunk in
 #   this request/response.
 FLAG_MORE_CHUNKS = 0x02
+# FLAG_ZLIB_COMPRESSED:
+# - In a request, this indicates that the sender accepts zlib-compressed
+#   response chunks for this request.  The helper compresses chunks whose body
+#   is at least edenfs.compressionthreshold bytes long, if doing so makes the
+#   body smaller.
+# - In a response, this indicates that the chunk body is compressed with zlib.
+#   Each chunk is compressed independently, and the data length in the header
+#   is the length of the compressed body.  Error chunks are never compressed.
+FLAG_ZLIB_COMPRESSED = 0x04
+# FLAG_STREAM_RESPONSE:
+# - This flag is only valid in CMD_CAT_FILE requests.  It indicates that the
+#   sender accepts the file contents split across multiple chunks of at most
+#   edenfs.catfilechunksize bytes each.  Without this flag the contents are
+#   always sent in a single chunk.
+FLAG_STREAM_RESPONSE = 0x08
+# FLAG_COMPACT_MANIFEST:
+# - This flag is only valid in CMD_MANIFEST requests.  It asks for the
+#   manifest entries in the compact, front-coded encoding described in
+#   CompactManifestEncoder instead of the default encoding.
+FLAG_COMPACT_MANIFEST = 0x10
+# FLAG_PREFETCH_PRIORITY:
+# - This flag is only valid in requests.  It marks the request as
+#   speculative prefetch work rather than interactive work that a user is
+#   waiting on.  When the helper runs with --workers, queued interactive
+#   requests are always handed to a worker before any queued prefetch
+#   requests.
+FLAG_PREFETCH_PRIORITY = 0x20
+
+# The type byte at the start of a CMD_CAT_FILE_DELTA response body.
+DELTA_TYPE_FULL = b'\x00'
+DELTA_TYPE_MDIFF = b'\x01'
+
+#
+# Configuration settings.
+#
+# These are read from the "edenfs" section of the mercurial configuration,
+# and can be set with --config arguments, e.g.
+# "--config edenfs.blobcachesize=128MB"
+#
+CONFIG_SECTION = 'edenfs'
+
+# The maximum total size of file contents kept in the in-memory blob cache,
+# including the per-entry overhead (see LRU_CACHE_ENTRY_OVERHEAD).  Set this
+# to 0 to disable the cache.
+DEFAULT_BLOB_CACHE_BYTES = 64 * 1024 * 1024
+# Files larger than this are never stored in the blob cache, so that a single
+# large file cannot evict everything else.
+DEFAULT_BLOB_CACHE_MAX_FILE_BYTES = 4 * 1024 * 1024
+# The maximum total size of the entries in the in-memory file metadata cache.
+# Each entry holds only 28 bytes of data, but is charged about 300 bytes
+# including its key and LRU_CACHE_ENTRY_OVERHEAD, so this holds about 28,000
+# entries.
+DEFAULT_METADATA_CACHE_BYTES = 8 * 1024 * 1024
+# The maximum total size of the entries in the in-memory revision cache,
+# which maps revision names to commit and manifest nodes.  Each entry holds
+# 40 bytes of data, but is charged for its LRU_CACHE_ENTRY_OVERHEAD as well.
+DEFAULT_REVISION_CACHE_BYTES = 4 * 1024 * 1024
+# Response chunks smaller than this are never compressed, since the savings
+# are not worth the CPU time.
+DEFAULT_COMPRESSION_THRESHOLD = 4096
+# The zlib compression level.  We favor speed over compression ratio.
+DEFAULT_COMPRESSION_LEVEL = 1
+# The initial, minimum and maximum body sizes of the chunks used to stream
+# manifest and batched file responses.  See ChunkSizer.
+DEFAULT_CHUNK_BYTES = 32 * 1024
+DEFAULT_MIN_CHUNK_BYTES = 4 * 1024
+DEFAULT_MAX_CHUNK_BYTES = 1024 * 1024
+# The maximum total size of the files in the on-disk manifest cache.
+# The cache itself is only enabled if edenfs.manifestcachedir is set.
+DEFAULT_MANIFEST_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+# The maximum number of background tasks (such as the remainder of a
+# depth-limited tree fetch) that may be waiting to run.  Further tasks are
+# dropped.
+DEFAULT_MAX_BACKGROUND_TASKS = 10000
+# The number of files to request from the remotefilelog server at once when
+# processing a CMD_PREFETCH request.  Progress is reported after each batch.
+DEFAULT_PREFETCH_BATCH_SIZE = 1000
+# The maximum body size of the chunks used to send CMD_CAT_FILE responses
+# when the request has FLAG_STREAM_RESPONSE set.
+DEFAULT_CAT_FILE_CHUNK_BYTES = 1024 * 1024
+# CMD_CAT_FILE_DELTA sends the full contents, without computing a delta, if
+# either revision of the file is larger than this.  Diffing large files is
+# slow and needs both revisions in memory.  Set this to 0 to compute deltas
+# of files of any size.
+DEFAULT_DELTA_MAX_FILE_BYTES = 2 * 1024 * 1024
+# The largest response that is kept in memory so that it can be sent again
+# to identical requests that arrived while it was being produced.  See
+# RequestCoalescer.  Requests waiting on a larger response are processed
+# again from scratch.
+DEFAULT_COALESCE_MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+# How often to log a summary of the request statistics, in seconds.
+# Set this to 0 to disable the log message.
+DEFAULT_STATS_LOG_INTERVAL = 300
+# Requests that have been waiting in the queue for longer than this many
+# seconds are answered with an error instead of being processed, since
+# edenfs has most likely given up on them already.  Set this to 0 to process
+# requests however long they have waited.  This only applies when the helper
+# runs with --workers.
+DEFAULT_REQUEST_TIMEOUT = 0
+# How long, in seconds, to remember that a revision, file or tree was not
+# found.  Repeated lookups fail immediately during this time, unless the
+# repository changes on disk.  Set this to 0 to disable the negative cache.
+DEFAULT_NEGATIVE_CACHE_TTL = 5
+# The maximum number of failed lookups remembered in the negative cache.
+DEFAULT_NEGATIVE_CACHE_ENTRIES = 10000
+
+# The upper bounds of the request latency histogram buckets, in milliseconds.
+# Requests that take longer than the last bound are counted in a final
+# overflow bucket.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                      10000, 30000]
+
+
+RepoSignature = collections.namedtuple('RepoSignature',
+                                       ['changelog', 'names', 'dirstate',
+                                        'packs'])
+
+
+def stat_signature(path):
+    '''
+    Return a value that changes whenever the specified file or directory is
+    modified, or None if it does not exist.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
 
 
 class Request(object):
@@ -122,6 +394,73 @@ class Request(object):
         self.command = command
         self.flags = flags
         self.body = body
+        # The number of response bytes sent so far, including chunk headers.
+        self.bytes_sent = 0
+        # The most expensive retry path taken while processing this request,
+        # if any.  See HgServer.record_retry()
+        self.retry = None
+        self.received_time = time.time()
+        # The response chunks sent so far, as (flags, data) tuples, when they
+        # are being recorded for RequestCoalescer.  This is set to None if
+        # recording was not requested or the response grew too large.
+        self.recorded_chunks = None
+        self._recorded_bytes = 0
+        self._max_recorded_bytes = 0
+
+    def start_recording(self, max_bytes):
+        self.recorded_chunks = []
+        self._max_recorded_bytes = max_bytes
+
+    def record_chunk(self, flags, data):
+        if self.recorded_chunks is None:
+            return
+        self._recorded_bytes += len(data)
+        if self._recorded_bytes > self._max_recorded_bytes:
+            self.recorded_chunks = None
+        else:
+            self.recorded_chunks.append((flags, data))
+
+    @property
+    def is_prefetch(self):
+        return bool(self.flags & FLAG_PREFETCH_PRIORITY)
+
+
+def encode_counters(counters):
+    '''
+    Encode a list of (name, value) counter tuples for sending in a response
+    body.
+
+    Format:
+    - <num_counters><counter>...
+      Fields:
+      - <num_counters>: The number of counters, as a 32-bit big-endian integer
+      - <counter>: <name_length><name><value>
+        - <name_length>: The name length, as a 32-bit big-endian integer.
+        - <name>: The counter name.
+        - <value>: The counter value, as a 64-bit big-endian integer.
+    '''
+    parts = [struct.pack(b'>I', len(counters))]
+    for name, value in counters:
+        name = name.encode('utf-8')
+        parts.append(struct.pack(b'>I', len(name)))
+        parts.append(name)
+        parts.append(struct.pack(b'>Q', value))
+    return b''.join(parts)
+
+
+def accepts_argument(func, name):
+    '''
+    Return True if the specified function accepts an argument with the
+    given name.  This is used to check for features in the installed
+    mercurial extensions.
+    '''
+    getargspec = getattr(inspect, 'getfullargspec', None)
+    if getargspec is None:
+        getargspec = inspect.getargspec
+    try:
+        return name in getargspec(func).args
+    except TypeError:
+        return False
 
 
 def cmd(command_id):
@@ -150,8 +489,794 @@ class HgUI(mercurial.ui.ui):
         return False
 
 
+# An estimate of the memory used by each LRUCache entry in addition to the
+# bytes of its key and value: the OrderedDict link and dict slot, and the
+# object headers of the key and value strings.  This dominates the size of
+# small entries.
+LRU_CACHE_ENTRY_OVERHEAD = 250
+
+
+class LRUCache(object):
+    '''
+    A thread-safe LRU cache whose total size is limited by a byte budget.
+
+    Each entry is charged len() of its value, plus len() of its key if the key
+    is a string, plus LRU_CACHE_ENTRY_OVERHEAD.  max_value_bytes limits just
+    the len() of the values that are stored.
+    '''
+    def __init__(self, name, max_bytes, max_value_bytes=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        if max_value_bytes is None:
+            max_value_bytes = max_bytes
+        self.max_value_bytes = min(max_value_bytes, max_bytes)
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            # Re-insert the entry to mark it as the most recently used
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_value_bytes:
+            return
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old_value = self._entries.pop(key, None)
+            if old_value is not None:
+                self._total_bytes -= self._entry_size(key, old_value)
+            self._entries[key] = value
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= self._entry_size(evicted_key, evicted)
+                self.evictions += 1
+
+    @staticmethod
+    def _entry_size(key, value):
+        size = len(value) + LRU_CACHE_ENTRY_OVERHEAD
+        if isinstance(key, bytes):
+            size += len(key)
+        return size
+
+    def get_counters(self):
+        with self._lock:
+            return [
+                (self.name + '.hits', self.hits),
+                (self.name + '.misses', self.misses),
+                (self.name + '.evictions', self.evictions),
+                (self.name + '.entries', len(self._entries)),
+                (self.name + '.bytes', self._total_bytes),
+                (self.name + '.max_bytes', self.max_bytes),
+            ]
+
+
+# The exceptions that indicate a revision, file or tree does not exist.
+# See HgServer.remember_failure()
+LOOKUP_ERRORS = (mercurial.error.LookupError, mercurial.error.RepoLookupError,
+                 KeyError)
+
+
+class NegativeCache(object):
+    '''
+    A thread-safe cache of recently failed lookups.
+
+    Each entry remembers the exception that the lookup raised, along with
+    the repository signature at the time (see HgServer._repo_signature()).
+    An entry is only used until its TTL expires, and only while the
+    repository signature is unchanged.
+    '''
+    def __init__(self, name, ttl, max_entries):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # Maps each key to an (expiry_time, signature, exception) tuple, in
+        # insertion order.
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.insertions = 0
+
+    def check(self, key, get_signature):
+        '''
+        Raise the remembered exception if a valid entry exists for key.
+
+        get_signature is only called if there is an entry to validate.
+        '''
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        expiry, signature, exc = entry
+        if time.time() >= expiry or get_signature() != signature:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            return
+        with self._lock:
+            self.hits += 1
+        raise exc
+
+    def add(self, key, signature, exc):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_entries:
+                # Entries are in insertion order, and all have the same TTL,
+                # so the oldest one expires first.
+                self._entries.popitem(last=False)
+            self._entries[key] = (now + self.ttl, signature, exc)
+            self.insertions += 1
+
+    def get_counters(self):
+        with self._lock:
+            return [
+                (self.name + '.hits', self.hits),
+                (self.name + '.insertions', self.insertions),
+                (self.name + '.entries', len(self._entries)),
+            ]
+
+
+# The format of each record in a request trace file: the time the request
+# was received, in microseconds since the trace was started; the request
+# header fields (txn_id, command, flags and body length); the number of
+# response bytes sent; and the time taken to respond, in microseconds.  The
+# request body follows.
+TRACE_RECORD_FORMAT = b'>QIIIIQQ'
+TRACE_RECORD_SIZE = struct.calcsize(TRACE_RECORD_FORMAT)
+
+TraceRecord = collections.namedtuple(
+    'TraceRecord',
+    ['received_us', 'txn_id', 'command', 'flags', 'body', 'bytes_sent',
+     'latency_us'])
+
+
+class TraceRecorder(object):
+    '''
+    Records every request processed by the helper in a trace file, for later
+    use with --replay-trace.
+
+    The file is opened in append mode and each record is written with a
+    single write() call, so forked zygote children can share it.
+    '''
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                           0o644)
+        self._start = time.time()
+
+    def record(self, request, latency):
+        header = struct.pack(
+            TRACE_RECORD_FORMAT,
+            int((request.received_time - self._start) * 1000000),
+            request.txn_id, request.command, request.flags,
+            len(request.body), request.bytes_sent, int(latency * 1000000))
+        os.write(self._fd, header + request.body)
+
+
+def read_trace(path):
+    '''
+    Read the TraceRecords from a trace file written by TraceRecorder.
+    '''
+    records = []
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(TRACE_RECORD_SIZE)
+            if not header:
+                break
+            if len(header) < TRACE_RECORD_SIZE:
+                raise Exception('trace file %s is truncated' % (path,))
+            (received_us, txn_id, command, flags, body_len, bytes_sent,
+             latency_us) = struct.unpack(TRACE_RECORD_FORMAT, header)
+            body = f.read(body_len)
+            if len(body) < body_len:
+                raise Exception('trace file %s is truncated' % (path,))
+            records.append(TraceRecord(received_us, txn_id, command, flags,
+                                       body, bytes_sent, latency_us))
+    return records
+
+
+class LFSBlobReader(object):
+    '''
+    Reads the contents of a blob from the lfs extension's local blob store
+    incrementally, verifying its hash as it goes.
+    '''
+    def __init__(self, oid, blob_file):
+        self.oid = oid
+        self._file = blob_file
+
+    def iter_pieces(self, chunk_size):
+        sha256 = hashlib.sha256()
+        with self._file:
+            while True:
+                piece = self._file.read(chunk_size)
+                if not piece:
+                    break
+                sha256.update(piece)
+                yield piece
+
+        # Any chunks sent before an error chunk are ignored, so it is safe to
+        # detect corruption only at the end.
+        if sha256.hexdigest() != self.oid:
+            raise Exception('lfs blob %s is corrupt' % (self.oid,))
+
+
+class ChunkSizer(object):
+    '''
+    Chooses the body size of the chunks used to stream large responses.
+
+    Too small and we pay a cost for doing too many small writes.
+    Too big and the C++ code is idle while it waits for us to build a
+    chunk, and then we fill up the pipe writing the data out, and have
+    to wait for it to be processed before we can start building the next
+    chunk.
+
+    The target size therefore adapts to how quickly the reader drains the
+    pipe.  If writing a chunk took longer than building it, the write blocked
+    waiting for the reader, so the target shrinks to let us build the next
+    chunk while the reader catches up.  Otherwise the target grows to reduce
+    the per-chunk overhead.
+    '''
+    def __init__(self, target_bytes, min_bytes, max_bytes):
+        self.min_bytes = min_bytes
+        self.max_bytes = max(min_bytes, max_bytes)
+        self.target_bytes = min(max(target_bytes, self.min_bytes),
+                                self.max_bytes)
+
+    def record(self, build_time, write_time):
+        if write_time > build_time:
+            target = self.target_bytes // 2
+        else:
+            target = self.target_bytes + self.target_bytes // 4
+        self.target_bytes = min(max(target, self.min_bytes), self.max_bytes)
+
+
+def encode_varint(value):
+    '''
+    Encode a non-negative integer as an unsigned LEB128 varint: 7 bits per
+    byte, least significant group first, with the high bit set on every byte
+    except the last.
+    '''
+    if value < 0x80:
+        # Fast path for the common case of a single byte
+        return chr(value)
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+class CompactManifestEncoder(object):
+    '''
+    Encodes manifest entries in the compact CMD_MANIFEST encoding.
+
+    Entries must be encoded in sorted path order.  Each entry has the format
+    <shared_len><suffix_len><suffix><flag><rev_hash>, where:
+    - <shared_len>: The number of leading bytes this entry's path shares with
+      the previous entry's path, as a varint (see encode_varint()).  This is
+      always 0 for the first entry in each response chunk, so that every
+      chunk can be decoded on its own.
+    - <suffix_len>: The length of the rest of the path, as a varint.
+    - <suffix>: The rest of the path.
+    - <flag>: The mercurial flag character ('x' or 'l'), or a nul byte for a
+      regular file.
+    - <rev_hash>: The file revision hash, as a 20-byte binary value.
+    '''
+    def __init__(self):
+        self._prev_path = b''
+
+    def reset(self):
+        '''
+        Start a new chunk: the next entry is encoded with its full path.
+        '''
+        self._prev_path = b''
+
+    def encode(self, entry):
+        path, hashval, flags = entry
+        prev = self._prev_path
+        # Binary search for the length of the shared prefix.  Comparing
+        # slices is done in C, which is much faster than comparing one byte
+        # at a time in python.
+        low = 0
+        high = min(len(prev), len(path))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if prev[:mid] == path[:mid]:
+                low = mid
+            else:
+                high = mid - 1
+        shared = low
+        self._prev_path = path
+        suffix = path[shared:]
+        return b''.join((encode_varint(shared), encode_varint(len(suffix)),
+                         suffix, flags or b'\0', hashval))
+
+
+class ManifestCache(object):
+    '''
+    An on-disk cache of serialized CMD_MANIFEST responses, keyed by manifest
+    node and encoding.
+
+    Each cache file contains the response body chunks in the order they were
+    originally sent, each one encoded as <length><data>, where <length> is a
+    32-bit big-endian integer.  Keeping the original chunk boundaries means
+    that every chunk served from the cache contains only complete entries.
+
+    When the total size of the cache files exceeds max_bytes, the least
+    recently used files are deleted.  Temporary files that have not been
+    modified for STALE_TMP_FILE_SECONDS are assumed to have been left behind
+    by a helper process that crashed, and are deleted as well.
+    '''
+    STALE_TMP_FILE_SECONDS = 60 * 60
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        self.prune()
+
+    def _file_path(self, manifest_node, encoding):
+        name = mercurial.node.hex(manifest_node)
+        if encoding:
+            name += '.' + encoding
+        return os.path.join(self.path, name)
+
+    def get_chunks(self, manifest_node, encoding=None):
+        '''
+        Return a list of the cached response chunks for the specified
+        manifest node and encoding, or None if it is not present in the
+        cache.  The default encoding is None.
+
+        The chunks are read from a memory-mapped view of the cache file.
+        '''
+        path = self._file_path(manifest_node, encoding)
+        try:
+            with open(path, 'rb') as f:
+                cache_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Find the chunk boundaries before returning anything, so a corrupt
+        # file is detected before any of its data has been sent.
+        chunk_ranges = []
+        offset = 0
+        while offset < len(cache_map):
+            if offset + 4 > len(cache_map):
+                break
+            length, = struct.unpack(b'>I', cache_map[offset:offset + 4])
+            offset += 4
+            if offset + length > len(cache_map):
+                break
+            chunk_ranges.append((offset, offset + length))
+            offset += length
+        if offset != len(cache_map) or not chunk_ranges:
+            logging.warning('ignoring corrupt manifest cache file %s', path)
+            cache_map.close()
+            self._remove(path)
+            return None
+
+        try:
+            # Update the modification time, for least recently used pruning.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return ManifestCacheChunks(cache_map, chunk_ranges)
+
+    def open_writer(self, manifest_node, encoding=None):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp.')
+        return ManifestCacheWriter(self, os.fdopen(fd, 'wb'), tmp_path,
+                                   self._file_path(manifest_node, encoding))
+
+    def prune(self):
+        entries = []
+        total_bytes = 0
+        stale_tmp_time = time.time() - self.STALE_TMP_FILE_SECONDS
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith('.tmp.'):
+                # This may still be being written by another request.
+                if st.st_mtime < stale_tmp_time:
+                    self._remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total_bytes += st.st_size
+
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class ManifestCacheChunks(object):
+    '''
+    The chunks of a cached manifest response, read from a memory-mapped file.
+    '''
+    def __init__(self, cache_map, chunk_ranges):
+        self._map = cache_map
+        self._ranges = chunk_ranges
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def __iter__(self):
+        try:
+            for start, end in self._ranges:
+                yield self._map[start:end]
+        finally:
+            self._map.close()
+
+
+class ManifestCacheWriter(object):
+    '''
+    Records the chunks of a manifest response as they are sent.
+
+    The data is written to a temporary file, which is only moved into place
+    by commit() once the full response has been recorded.
+    '''
+    def __init__(self, cache, tmp_file, tmp_path, path):
+        self._cache = cache
+        self._file = tmp_file
+        self._tmp_path = tmp_path
+        self._path = path
+
+    def add_chunk(self, data):
+        self._file.write(struct.pack(b'>I', len(data)))
+        self._file.write(data)
+
+    def commit(self):
+        self._file.close()
+        os.rename(self._tmp_path, self._path)
+        self._cache.prune()
+
+    def abort(self):
+        self._file.close()
+        self._cache._remove(self._tmp_path)
+
+
+class RequestCoalescer(object):
+    '''
+    Tracks the requests currently being processed, so that an identical
+    request that arrives in the meantime can wait for the first one's
+    response rather than doing the same work again.
+
+    Requests are identical if they have the same command, body and flags,
+    ignoring their priority.
+    '''
+    def __init__(self, commands, max_response_bytes):
+        self.commands = commands
+        self.max_response_bytes = max_response_bytes
+        self._lock = threading.Lock()
+        # Maps each in-flight request key to the list of requests waiting
+        # for its response.
+        self._in_flight = {}
+        self._coalesced = collections.Counter()
+        self._bytes_saved = collections.Counter()
+
+    def _key(self, request):
+        return (request.command, request.flags & ~FLAG_PREFETCH_PRIORITY,
+                request.body)
+
+    def start(self, request):
+        '''
+        Called before processing a request.
+
+        Returns False if an identical request is already being processed, in
+        which case this request has been added to its waiters and must not be
+        processed.  Otherwise returns True and starts recording the request's
+        response.
+        '''
+        if request.command not in self.commands:
+            return True
+        key = self._key(request)
+        with self._lock:
+            waiters = self._in_flight.get(key)
+            if waiters is not None:
+                waiters.append(request)
+                return False
+            self._in_flight[key] = []
+        request.start_recording(self.max_response_bytes)
+        return True
+
+    def finish(self, request, command_name):
+        '''
+        Called after processing a request.
+
+        Returns the list of requests that were waiting for its response.
+        '''
+        if request.command not in self.commands:
+            return []
+        with self._lock:
+            waiters = self._in_flight.pop(self._key(request))
+            if waiters and request.recorded_chunks is not None:
+                self._coalesced[command_name] += len(waiters)
+                self._bytes_saved[command_name] += len(waiters) * sum(
+                    len(data) for _flags, data in request.recorded_chunks)
+        return waiters
+
+    def get_counters(self):
+        with self._lock:
+            counters = []
+            for name in sorted(self._coalesced):
+                counters.append(('coalesce.%s.requests' % name,
+                                 self._coalesced[name]))
+                counters.append(('coalesce.%s.bytes_saved' % name,
+                                 self._bytes_saved[name]))
+            return counters
+
+
+class BackgroundTask(object):
+    '''
+    A low priority piece of work that is not associated with any request.
+    '''
+    def __init__(self, key, func):
+        self.key = key
+        self.func = func
+
+
+class CommandStats(object):
+    '''
+    Counters for the requests processed for a single command type.
+    '''
+    def __init__(self):
+        self.outcomes = collections.Counter()
+        self.bytes_sent = 0
+        self.latency_us_total = 0
+        self.latency_us_max = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, outcome, latency, bytes_sent):
+        self.outcomes[outcome] += 1
+        self.bytes_sent += bytes_sent
+        latency_us = int(latency * 1000000)
+        self.latency_us_total += latency_us
+        self.latency_us_max = max(self.latency_us_max, latency_us)
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS_MS,
+                                                latency * 1000)] += 1
+
+    def count(self):
+        return sum(self.outcomes.values())
+
+
+class ServerStats(object):
+    '''
+    Request counters and latency histograms, broken down by command and by
+    outcome.
+
+    The outcome of a request is one of:
+    - "success"
+    - "error": an error response was sent
+    - "cancelled": the request was dropped from the queue without being
+      processed, either because of a CMD_CANCEL request or because it timed
+      out
+    - "retry_refresh_packs": the request succeeded, but only after
+      refreshing the list of pack files and trying again
+    - "retry_invalidate": the request succeeded, but only after invalidating
+      the repository's cached changelog data and trying again
+    - "retry_reopen": the request succeeded, but only after re-opening the
+      repository and trying again
+
+    If several retry paths were taken the most expensive one is reported.
+    Retries are also counted separately for each function that performs
+    them, whatever the final outcome of the request.
+    '''
+    # Retry outcomes are listed from least to most expensive.
+    RETRY_OUTCOMES = ('retry_refresh_packs', 'retry_invalidate',
+                      'retry_reopen')
+    OUTCOMES = ('success', 'error', 'cancelled') + RETRY_OUTCOMES
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = collections.defaultdict(CommandStats)
+        self._retries = collections.Counter()
+
+    def record_request(self, command_name, outcome, latency, bytes_sent):
+        with self._lock:
+            self._commands[command_name].record(outcome, latency, bytes_sent)
+
+    def record_retry(self, function_name, kind):
+        with self._lock:
+            self._retries[function_name + '.' + kind] += 1
+
+    def get_counters(self):
+        counters = []
+        with self._lock:
+            total_bytes = 0
+            for name, stats in sorted(self._commands.items()):
+                prefix = 'command.' + name + '.'
+                for outcome in self.OUTCOMES:
+                    counters.append((prefix + outcome,
+                                     stats.outcomes[outcome]))
+                counters.append((prefix + 'bytes_sent', stats.bytes_sent))
+                counters.append((prefix + 'latency_us_total',
+                                 stats.latency_us_total))
+                counters.append((prefix + 'latency_us_max',
+                                 stats.latency_us_max))
+                for bound, count in zip(LATENCY_BUCKETS_MS,
+                                        stats.latency_buckets):
+                    counters.append((prefix + 'latency_ms_le_%d' % bound,
+                                     count))
+                counters.append((prefix + 'latency_ms_over_%d' %
+                                 LATENCY_BUCKETS_MS[-1],
+                                 stats.latency_buckets[-1]))
+                total_bytes += stats.bytes_sent
+            counters.append(('bytes_sent', total_bytes))
+            for name, count in sorted(self._retries.items()):
+                counters.append(('retry.' + name, count))
+        return counters
+
+    def summary(self):
+        '''
+        Return a one-line summary of the request statistics, for logging.
+        '''
+        parts = []
+        with self._lock:
+            for name, stats in sorted(self._commands.items()):
+                count = stats.count()
+                retries = sum(stats.outcomes[outcome]
+                              for outcome in self.RETRY_OUTCOMES)
+                parts.append('%s: n=%d err=%d retry=%d avg=%.1fms '
+                             'max=%.1fms bytes=%d' % (
+                                 name, count, stats.outcomes['error'],
+                                 retries,
+                                 stats.latency_us_total / 1000.0 / count,
+                                 stats.latency_us_max / 1000.0,
+                                 stats.bytes_sent))
+        return '; '.join(parts)
+
+
+class RequestQueue(object):
+    '''
+    A queue of requests waiting to be processed, along with a queue of
+    background tasks.
+
+    Interactive requests are handed out before prefetch requests (see
+    FLAG_PREFETCH_PRIORITY), and background tasks are only handed out when no
+    requests are waiting.
+    '''
+    def __init__(self, max_background_tasks=DEFAULT_MAX_BACKGROUND_TASKS,
+                 max_active_background_tasks=0):
+        self._cond = threading.Condition()
+        self._requests = collections.deque()
+        self._prefetch_requests = collections.deque()
+        # Background tasks, keyed by BackgroundTask.key so that the same work
+        # is not queued more than once.
+        self._background = collections.OrderedDict()
+        self._max_background = max_background_tasks
+        # Limit how many threads may run background tasks at once, so that
+        # some are always available to pick up new requests.  If this is 0,
+        # background tasks are never run.
+        self._max_active_background = max_active_background_tasks
+        self._active_background = 0
+        self._closed = False
+
+    def put(self, request):
+        with self._cond:
+            if request.is_prefetch:
+                self._prefetch_requests.append(request)
+            else:
+                self._requests.append(request)
+            self._cond.notify()
+
+    def cancel(self, txn_id):
+        '''
+        Remove the queued request with the specified transaction ID.
+
+        Returns the removed Request, or None if no such request is queued.
+        '''
+        with self._cond:
+            for queue in (self._requests, self._prefetch_requests):
+                for request in queue:
+                    if request.txn_id == txn_id:
+                        queue.remove(request)
+                        return request
+        return None
+
+    def put_background(self, task):
+        '''
+        Queue a background task.
+
+        Returns False if the task was dropped because the queue is full.
+        '''
+        with self._cond:
+            if task.key in self._background:
+                return True
+            if len(self._background) >= self._max_background:
+                return False
+            self._background[task.key] = task
+            self._cond.notify()
+            return True
+
+    def get(self):
+        '''
+        Get the next Request or BackgroundTask to process, blocking until one
+        is available.
+
+        Returns None once the queue has been closed and all of the queued
+        requests have been handed out.  Pending background tasks are
+        discarded when the queue is closed.
+        '''
+        with self._cond:
+            while True:
+                if self._requests:
+                    return self._requests.popleft()
+                if self._prefetch_requests:
+                    return self._prefetch_requests.popleft()
+                if self._closed:
+                    return None
+                task = self._pop_background()
+                if task is not None:
+                    return task
+                self._cond.wait()
+
+    def accepts_background(self):
+        '''
+        Return True if queued background tasks will ever be run.
+        '''
+        return self._max_active_background > 0
+
+    def _pop_background(self):
+        if (not self._background or
+                self._active_background >= self._max_active_background):
+            return None
+        _key, task = self._background.popitem(last=False)
+        self._active_background += 1
+        return task
+
+    def background_task_done(self):
+        with self._cond:
+            self._active_background -= 1
+            self._cond.notify()
+
+    def close(self):
+        '''
+        Make get() return None in all threads once all previously queued
+        requests have been handed out.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
 class HgServer(object):
-    def __init__(self, repo_path, config_overrides, in_fd=None, out_fd=None):
+    def __init__(self, repo_path, config_overrides, in_fd=None, out_fd=None,
+                 num_workers=0):
         '''
         Create an HgServer.
 
@@ -168,21 +1293,62 @@ class HgServer(object):
         out_fd:
           A file descriptor to use for sending responses.
           If in_fd is None, stdout will be used.
+        num_workers:
+          The number of worker threads to use for processing requests.
+          If this is 0 requests are processed one at a time in the order they
+          were received.  Otherwise requests are processed concurrently and
+          responses are sent in completion order.
         '''
         self.repo_path = repo_path
         self.config_overrides = config_overrides
-        if in_fd is None:
-            self.in_file = sys.stdin
-        else:
-            self.in_file = os.fdopen(in_fd, 'rb')
-        if out_fd is None:
-            self.out_file = sys.stdout
-        else:
-            self.out_file = os.fdopen(out_fd, 'wb')
+        self._set_fds(in_fd, out_fd)
+        self.num_workers = num_workers
+        # Background tasks may use all but one of the worker threads, so
+        # that one is always free for new requests.  With fewer than two
+        # workers background tasks are not run at all, since a long-running
+        # task would block the next request.
+        self.request_queue = RequestQueue(
+            max_active_background_tasks=max(0, num_workers - 1))
+        self.coalescer = RequestCoalescer(
+            (CMD_CAT_FILE, CMD_CAT_FILE_DELTA, CMD_FETCH_TREE),
+            DEFAULT_COALESCE_MAX_RESPONSE_BYTES)
+
+        # Responses may be sent from several worker threads at once.
+        # Each chunk is written out while holding this lock.
+        self._send_lock = threading.Lock()
+
+        # Per-thread state.  Each thread gets its own repository object,
+        # since mercurial repository objects are not thread-safe.  This also
+        # tracks the request currently being processed by each thread.
+        self._thread_state = threading.local()
+        # Repository objects opened by serve_zygote() for the worker threads
+        # of its forked children, as (repo, RepoSignature) tuples.
+        self._worker_repos = []
+
+        self.stats = ServerStats()
+        self._stats_log_interval = DEFAULT_STATS_LOG_INTERVAL
+        self._next_stats_log = time.time() + self._stats_log_interval
+        self._request_timeout = DEFAULT_REQUEST_TIMEOUT
+        # If set, a TraceRecorder that every processed request is passed to
+        self.trace_recorder = None
+
+        # The pack directories checked by _repo_signature()
+        self._pack_dirs = None
 
         # The repository will be set during initialized()
         self.repo = None
         self.ui = None
+        self.blob_cache = None
+        self.metadata_cache = None
+        self.revision_cache = None
+        self.negative_cache = NegativeCache('negative_cache', 0, 0)
+        self.compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+        self.compression_level = DEFAULT_COMPRESSION_LEVEL
+        self.chunk_sizer = ChunkSizer(DEFAULT_CHUNK_BYTES,
+                                      DEFAULT_MIN_CHUNK_BYTES,
+                                      DEFAULT_MAX_CHUNK_BYTES)
+        self.manifest_cache = None
+        self.cat_file_chunk_size = DEFAULT_CAT_FILE_CHUNK_BYTES
 
         # Populate our command dictionary
         self._commands = {}
@@ -192,6 +1358,21 @@ class HgServer(object):
                 continue
             self._commands[value.__COMMAND_ID__] = value
 
+    def _set_fds(self, in_fd, out_fd):
+        if in_fd is None:
+            self.in_file = sys.stdin
+        else:
+            self.in_file = os.fdopen(in_fd, 'rb')
+        if out_fd is None:
+            self.out_file = sys.stdout
+        else:
+            self.out_file = os.fdopen(out_fd, 'wb')
+        # Requests are read from and responses are written to the file
+        # descriptors directly, bypassing the buffering done by the file
+        # objects.
+        self.in_fd = self.in_file.fileno()
+        self.out_fd = self.out_file.fileno()
+
     def initialize(self):
         self.ui = HgUI.load()
         for opt in self.config_overrides:
@@ -213,6 +1394,218 @@ class HgServer(object):
             # The treemanifest extension is not present
             self.treemanifest = None
 
+        try:
+            self.lfs = mercurial.extensions.find('lfs')
+        except KeyError:
+            self.lfs = None
+
+        self.blob_cache = LRUCache(
+            'blob_cache',
+            self.ui.configbytes(CONFIG_SECTION, 'blobcachesize',
+                                DEFAULT_BLOB_CACHE_BYTES),
+            self.ui.configbytes(CONFIG_SECTION, 'blobcachemaxfilesize',
+                                DEFAULT_BLOB_CACHE_MAX_FILE_BYTES))
+        self.metadata_cache = LRUCache(
+            'metadata_cache',
+            self.ui.configbytes(CONFIG_SECTION, 'metadatacachesize',
+                                DEFAULT_METADATA_CACHE_BYTES))
+        self.revision_cache = LRUCache(
+            'revision_cache',
+            self.ui.configbytes(CONFIG_SECTION, 'revisioncachesize',
+                                DEFAULT_REVISION_CACHE_BYTES))
+        self.negative_cache = NegativeCache(
+            'negative_cache',
+            self.ui.configint(CONFIG_SECTION, 'negativecachettl',
+                              DEFAULT_NEGATIVE_CACHE_TTL),
+            self.ui.configint(CONFIG_SECTION, 'negativecacheentries',
+                              DEFAULT_NEGATIVE_CACHE_ENTRIES))
+        self.compression_threshold = self.ui.configbytes(
+            CONFIG_SECTION, 'compressionthreshold',
+            DEFAULT_COMPRESSION_THRESHOLD)
+        self.compression_level = self.ui.configint(
+            CONFIG_SECTION, 'compressionlevel', DEFAULT_COMPRESSION_LEVEL)
+        self.chunk_sizer = ChunkSizer(
+            self.ui.configbytes(CONFIG_SECTION, 'chunksize',
+                                DEFAULT_CHUNK_BYTES),
+            self.ui.configbytes(CONFIG_SECTION, 'minchunksize',
+                                DEFAULT_MIN_CHUNK_BYTES),
+            self.ui.configbytes(CONFIG_SECTION, 'maxchunksize',
+                                DEFAULT_MAX_CHUNK_BYTES))
+
+        self.cat_file_chunk_size = self.ui.configbytes(
+            CONFIG_SECTION, 'catfilechunksize', DEFAULT_CAT_FILE_CHUNK_BYTES)
+        self.delta_max_file_size = self.ui.configbytes(
+            CONFIG_SECTION, 'deltamaxfilesize', DEFAULT_DELTA_MAX_FILE_BYTES)
+        self._stats_log_interval = self.ui.configint(
+            CONFIG_SECTION, 'statsloginterval', DEFAULT_STATS_LOG_INTERVAL)
+        self._next_stats_log = time.time() + self._stats_log_interval
+        self._request_timeout = self.ui.configint(
+            CONFIG_SECTION, 'requesttimeout', DEFAULT_REQUEST_TIMEOUT)
+        self.coalescer.max_response_bytes = self.ui.configbytes(
+            CONFIG_SECTION, 'coalescemaxresponsesize',
+            DEFAULT_COALESCE_MAX_RESPONSE_BYTES)
+
+        manifest_cache_dir = self.ui.config(CONFIG_SECTION,
+                                            'manifestcachedir')
+        if manifest_cache_dir:
+            self.manifest_cache = ManifestCache(
+                manifest_cache_dir,
+                self.ui.configbytes(CONFIG_SECTION, 'manifestcachesize',
+                                    DEFAULT_MANIFEST_CACHE_BYTES))
+
+    @property
+    def repo(self):
+        '''
+        The repository object for the current thread.
+
+        Worker threads lazily open their own repository object the first time
+        they access this property.
+        '''
+        repo = getattr(self._thread_state, 'repo', None)
+        if repo is None and self.ui is not None:
+            repo = self._open_repo()
+            self.repo = repo
+        return repo
+
+    @repo.setter
+    def repo(self, repo):
+        self._thread_state.repo = repo
+        # Record the on-disk state this repository object reflects.
+        # See refresh_repo_if_changed()
+        if repo is None:
+            self._thread_state.signature = None
+        else:
+            self._thread_state.signature = self._repo_signature(repo)
+
+    def _repo_signature(self, repo):
+        '''
+        Compute a cheap signature of the repository's on-disk state, from
+        stat() calls on the changelog files, the bookmark and remote name
+        files, the dirstate and the pack file directories.
+        '''
+        packs = tuple(stat_signature(path)
+                      for path in self._get_pack_dirs(repo))
+        return RepoSignature(self._changelog_signature(repo),
+                             self._names_signature(repo),
+                             stat_signature(repo.vfs.join(b'dirstate')),
+                             packs)
+
+    def _changelog_signature(self, repo):
+        return tuple(
+            stat_signature(repo.svfs.join(name))
+            for name in ('00changelog.i', '00changelog.i.a', '00changelog.d'))
+
+    def _names_signature(self, repo):
+        # Bookmarks can be created or moved, and remote names (stored by the
+        # remotenames extension, if it is enabled) can move to an existing
+        # commit, without the changelog changing.
+        return tuple(stat_signature(repo.vfs.join(name))
+                     for name in ('bookmarks', 'remotenames'))
+
+    def _get_pack_dirs(self, repo):
+        if self._pack_dirs is None:
+            pack_dirs = []
+            for category in (constants.FILEPACK_CATEGORY,
+                             constants.TREEPACK_CATEGORY):
+                pack_dirs.append(shallowutil.getlocalpackpath(
+                    repo.svfs.vfs.base, category))
+                try:
+                    pack_dirs.append(shallowutil.getcachepackpath(
+                        repo, category))
+                except Exception:
+                    # The shared cache path is not configured for this repo.
+                    pass
+            self._pack_dirs = pack_dirs
+        return self._pack_dirs
+
+    def refresh_repo_if_changed(self, function_name):
+        '''
+        Check if the repository has changed on disk since this thread's
+        repository object was opened or last refreshed, and if so refresh the
+        parts of it that changed.
+
+        Returns True if anything changed, in which case it is worth retrying
+        an operation that failed.
+        '''
+        old_signature = self._thread_state.signature
+        new_signature = self._repo_signature(self.repo)
+        if new_signature == old_signature:
+            return False
+
+        self._thread_state.signature = new_signature
+        if (new_signature.changelog != old_signature.changelog or
+                new_signature.names != old_signature.names):
+            # clearfilecache=True is necessary so that mercurial will open
+            # 00changelog.i.a if it exists now instead of just using
+            # 00changelog.i  The .a file contains pending commit data if a
+            # transaction is in progress.  This also drops the cached
+            # bookmarks and remote names.
+            self.record_retry(function_name, 'invalidate')
+            self.repo.invalidate(clearfilecache=True)
+        if new_signature.dirstate != old_signature.dirstate:
+            # The working directory parent, which "." refers to, is read from
+            # the dirstate.
+            self.record_retry(function_name, 'invalidate')
+            self.repo.invalidatedirstate()
+        if new_signature.packs != old_signature.packs:
+            self.record_retry(function_name, 'refresh_packs')
+            self._refresh_packs()
+        return True
+
+    def _refresh_packs(self):
+        '''
+        Tell the remotefilelog and treemanifest pack stores to rescan their
+        directories for new pack files.
+        '''
+        repo = self.repo
+        stores = [
+            getattr(repo, 'contentstore', None),
+            getattr(repo, 'metadatastore', None),
+            getattr(repo.svfs, 'manifestdatastore', None),
+            getattr(repo.svfs, 'manifesthistorystore', None),
+        ]
+        for store in stores:
+            if store is not None and hasattr(store, 'markforrefresh'):
+                store.markforrefresh()
+
+    @contextlib.contextmanager
+    def remember_failure(self, key):
+        '''
+        A context manager for a lookup that may fail because the data does
+        not exist (yet).
+
+        If the same lookup failed recently and the repository has not changed
+        on disk since, the remembered exception is raised right away without
+        running the body.  Otherwise the body runs, and if it raises one of
+        the LOOKUP_ERRORS the exception is remembered in self.negative_cache.
+        Other errors, such as transient network or server failures, are not
+        remembered.
+        '''
+        self.negative_cache.check(
+            key, lambda: self._repo_signature(self.repo))
+        try:
+            yield
+        except LOOKUP_ERRORS as ex:
+            self.negative_cache.add(key, self._repo_signature(self.repo), ex)
+            raise
+
+    def reopen_repo_if_changed(self, function_name):
+        '''
+        Re-open this thread's repository object, unless it has already been
+        re-opened since the repository last changed on disk.
+
+        Returns True if the repository was re-opened.
+        '''
+        signature = self._repo_signature(self.repo)
+        reopened = getattr(self._thread_state, 'reopened_signature', None)
+        if reopened == signature:
+            return False
+
+        self.record_retry(function_name, 'reopen')
+        self.repo = self._open_repo()
+        self._thread_state.reopened_signature = self._thread_state.signature
+        return True
+
     def _open_repo(self):
         # Create the repository using the original clean UI object that has not
         # loaded the repo config yet.  This is required to ensure that
@@ -236,14 +1629,96 @@ class HgServer(object):
             self.send_exception(request=None, exc=ex)
             return 1
 
+        return self._serve_initialized()
+
+    def serve_zygote(self, socket_path):
+        '''
+        Run as a zygote process.
+
+        The zygote initializes mercurial and opens the repository once, then
+        listens for connections on a unix socket at socket_path.  For each
+        connection it forks a child process that serves requests over that
+        connection, exactly as if it had been started with --in-fd and
+        --out-fd.  The children inherit the zygote's already-initialized
+        state, so they can send CMD_STARTED immediately.
+
+        With --workers, the zygote also opens a repository object for each
+        worker thread, so that the children do not need to open any.
+        '''
+        try:
+            self.initialize()
+            for _ in range(self.num_workers):
+                repo = self._open_repo()
+                self._worker_repos.append((repo, self._repo_signature(repo)))
+        except Exception as ex:
+            # If an error occurs during initialization (say, if the repository
+            # path is invalid), send an error response.  Also remove any
+            # socket left behind by an earlier zygote, so that clients fail
+            # to connect rather than waiting for a zygote that is not there.
+            self.send_exception(request=None, exc=ex)
+            remove_socket(socket_path)
+            return 1
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        remove_socket(socket_path)
+        listener.bind(socket_path)
+        listener.listen(socket.SOMAXCONN)
+
+        signal.signal(signal.SIGCHLD, reap_children)
+        logging.info('hg_import_helper zygote for %s listening on %s',
+                     self.repo_path, socket_path)
+        try:
+            while True:
+                try:
+                    conn, _addr = listener.accept()
+                except socket.error as ex:
+                    if ex.errno == errno.EINTR:
+                        continue
+                    raise
+
+                pid = os.fork()
+                if pid == 0:
+                    # We are the child.  Exit with os._exit() so that we
+                    # never return into the zygote's accept loop.
+                    rc = 1
+                    try:
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        listener.close()
+                        rc = self._serve_forked_child(conn)
+                    except BaseException:
+                        logging.exception('error in forked hg_import_helper')
+                    finally:
+                        os._exit(rc)
+
+                self.debug('forked hg_import_helper child %d', pid)
+                conn.close()
+        finally:
+            listener.close()
+            try:
+                remove_socket(socket_path)
+            except OSError:
+                pass
+
+    def _serve_forked_child(self, conn):
+        self._set_fds(os.dup(conn.fileno()), os.dup(conn.fileno()))
+        conn.close()
+
+        # The repository may have changed since the zygote opened it.
+        self.refresh_repo_if_changed('zygote_child')
+        return self._serve_initialized()
+
+    def _serve_initialized(self):
         # Send a CMD_STARTED response to indicate we have started,
         # and include some information about the repository configuration.
         options_chunk = self._gen_options()
         self._send_chunk(txn_id=0, command=CMD_STARTED,
                          flags=0, data=options_chunk)
 
-        while self.process_request():
-            pass
+        if self.num_workers > 0:
+            self._serve_concurrently()
+        else:
+            while self.process_request():
+                pass
 
         logging.debug('hg_import_helper shutting down normally')
         return 0
@@ -252,7 +1727,10 @@ class HgServer(object):
         use_treemanifest = ((self.treemanifest is not None) and
                             bool(getattr(self.repo, 'name', None)))
 
-        flags = 0
+        flags = (START_FLAGS_ZLIB_SUPPORTED |
+                 START_FLAGS_COMPACT_MANIFEST_SUPPORTED)
+        if self.num_workers > 0:
+            flags |= START_FLAGS_CONCURRENT_RESPONSES
         treemanifest_paths = []
         if use_treemanifest:
             flags |= START_FLAGS_TREEMANIFEST_SUPPORTED
@@ -265,7 +1743,7 @@ class HgServer(object):
 
         # Options format:
         # - Protocol version number
-        # - Is treemanifest supported?
+        # - START_FLAGS_* bit set
         # - Number of treemanifest paths
         #   - treemanifest paths, encoded as (length, string_data)
         parts = []
@@ -280,13 +1758,165 @@ class HgServer(object):
     def debug(self, msg, *args, **kwargs):
         logging.debug(msg, *args, **kwargs)
 
+    def _serve_concurrently(self):
+        '''
+        Serve requests using self.num_workers worker threads.
+
+        The calling thread reads requests from the input pipe and hands them
+        off to the workers, so that a slow request (for instance a
+        remotefilelog fetch) does not hold up cheaper requests queued behind
+        it.
+        '''
+        worker_repos = self._worker_repos
+        self._worker_repos = []
+        workers = []
+        for n in range(self.num_workers):
+            worker_repo = worker_repos[n] if n < len(worker_repos) else None
+            thread = threading.Thread(target=self._worker_loop,
+                                      args=(worker_repo,),
+                                      name='hg_import_worker_%d' % n)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+        try:
+            while True:
+                request = self._read_request()
+                if request is None:
+                    break
+                if request.command == CMD_CANCEL:
+                    # Handle cancellation right away, rather than queueing it
+                    # behind the requests it is trying to cancel.
+                    self._dispatch(request)
+                else:
+                    self.request_queue.put(request)
+        finally:
+            self.request_queue.close()
+            for thread in workers:
+                thread.join()
+
+    def _worker_loop(self, worker_repo=None):
+        try:
+            if worker_repo is not None:
+                # Use the repository object that the zygote opened for this
+                # worker.  The repository may have changed since then.
+                self._thread_state.repo, self._thread_state.signature = (
+                    worker_repo)
+                self.refresh_repo_if_changed('zygote_child')
+            else:
+                # Open this thread's repository object up front, rather than
+                # while processing the first request.
+                self.repo
+        except Exception:
+            logging.exception('error opening repository in worker thread')
+
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                return
+            try:
+                self._process_item(item)
+            except Exception:
+                # Keep this worker alive.  _dispatch() already sends error
+                # responses, so this is only reached if sending one failed.
+                logging.exception('unexpected error in worker thread')
+
+    def _process_item(self, item):
+        if isinstance(item, BackgroundTask):
+            self._run_background_task(item)
+        elif self._request_timed_out(item):
+            self._drop_request(item, 'TimeoutError',
+                               'request timed out after waiting %.1f '
+                               'seconds' % (time.time() - item.received_time))
+        else:
+            self._dispatch_coalesced(item)
+
+    def _dispatch_coalesced(self, request):
+        '''
+        Process a request, unless an identical request is already being
+        processed by another thread.  In that case the other thread sends
+        the response for this request as well, once it is ready.
+        '''
+        if not self.coalescer.start(request):
+            return
+        start = time.time()
+        try:
+            outcome = self._dispatch(request)
+        except Exception:
+            # The response may be incomplete, so it cannot be replayed.
+            request.recorded_chunks = None
+            raise
+        finally:
+            waiters = self.coalescer.finish(
+                request, self._command_name(request.command))
+            if request.recorded_chunks is None:
+                # The response was too large to keep around, or could not be
+                # sent.  Put the waiters back in the queue, so that they are
+                # processed by whichever workers are free.
+                for waiter in waiters:
+                    self.request_queue.put(waiter)
+                waiters = []
+
+        for waiter in waiters:
+            for flags, data in request.recorded_chunks:
+                waiter.bytes_sent += HEADER_SIZE + len(data)
+                self._send_chunk(waiter.txn_id, command=CMD_RESPONSE,
+                                 flags=flags, data=data)
+            self._record_request(self._command_name(waiter.command), outcome,
+                                 waiter, start)
+
+    def _request_timed_out(self, request):
+        return (self._request_timeout > 0 and
+                time.time() - request.received_time > self._request_timeout)
+
+    def _drop_request(self, request, error_type, message):
+        '''
+        Answer a queued request with an error response, without processing
+        it.
+        '''
+        start = time.time()
+        self.debug('dropping request %d: %s', request.txn_id, message)
+        self.send_error(request, error_type, message)
+        self._record_request(self._command_name(request.command), 'cancelled',
+                             request, start)
+
+    def _command_name(self, command):
+        cmd_function = self._commands.get(command)
+        if cmd_function is None:
+            return 'unknown'
+        # Strip the "cmd_" prefix from the handler name
+        return cmd_function.__name__[4:]
+
+    def _run_background_task(self, task):
+        try:
+            task.func()
+        except Exception:
+            logging.exception('error running background task %r', task.key)
+        finally:
+            self.request_queue.background_task_done()
+
     def process_request(self):
-        # Read the request header
-        header_data = self.in_file.read(HEADER_SIZE)
-        if not header_data:
+        request = self._read_request()
+        if request is None:
             # EOF.  All done serving
             return False
 
+        self._dispatch(request)
+
+        # Return True to indicate that we should continue serving
+        return True
+
+    def _read_request(self):
+        '''
+        Read the next request from the input pipe.
+
+        Returns None on EOF.
+        '''
+        # Read the request header
+        header_data = read_exact(self.in_fd, HEADER_SIZE)
+        if not header_data:
+            return None
+
         if len(header_data) < HEADER_SIZE:
             raise Exception('received EOF after partial request header')
 
@@ -294,92 +1924,560 @@ class HgServer(object):
         txn_id, command, flags, data_len = header_fields
 
         # Read the request body
-        body = self.in_file.read(data_len)
+        body = read_exact(self.in_fd, data_len)
         if len(body) < data_len:
             raise Exception('received EOF after partial request')
-        req = Request(txn_id, command, flags, body)
+        return Request(txn_id, command, flags, body)
 
-        cmd_function = self._commands.get(command)
+    def _dispatch(self, req):
+        start = time.time()
+        cmd_function = self._commands.get(req.command)
         if cmd_function is None:
-            logging.warning('unknown command %r', command)
+            logging.warning('unknown command %r', req.command)
             self.send_error(req, 'CommandError',
-                            'unknown command %r' % (command,))
-            return True
+                            'unknown command %r' % (req.command,))
+            self._record_request('unknown', 'error', req, start)
+            return 'error'
 
+        self._thread_state.request = req
         try:
             cmd_function(req)
+            outcome = req.retry or 'success'
         except Exception as ex:
-            logging.exception('error processing command %r', command)
+            logging.exception('error processing command %r', req.command)
             self.send_exception(req, ex)
+            outcome = 'error'
+        finally:
+            self._thread_state.request = None
+
+        self._record_request(self._command_name(req.command), outcome, req,
+                             start)
+        return outcome
+
+    def _record_request(self, command_name, outcome, req, start):
+        now = time.time()
+        self.stats.record_request(command_name, outcome, now - start,
+                                  req.bytes_sent)
+        if self.trace_recorder is not None:
+            self.trace_recorder.record(req, now - req.received_time)
+        if self._stats_log_interval > 0 and now >= self._next_stats_log:
+            self._next_stats_log = now + self._stats_log_interval
+            logging.info('hg_import_helper stats: %s', self.stats.summary())
+
+    def record_retry(self, function_name, kind):
+        '''
+        Record that a retry path was taken while processing the current
+        request.
+
+        kind should be one of "refresh_packs", "invalidate" or "reopen".
+        '''
+        self.stats.record_retry(function_name, kind)
+        req = getattr(self._thread_state, 'request', None)
+        if req is None:
+            return
+        outcome = 'retry_' + kind
+        order = ServerStats.RETRY_OUTCOMES
+        if req.retry is None or order.index(outcome) > order.index(req.retry):
+            req.retry = outcome
+
+    @cmd(CMD_MANIFEST)
+    def cmd_manifest(self, request):
+        '''
+        Handler for CMD_MANIFEST requests.
+
+        This request asks for the full mercurial manifest contents for a given
+        revision.  The response body will be split across one or more chunks.
+        (FLAG_MORE_CHUNKS will be set on all but the last chunk.)
+
+        Request body format:
+        - <rev_name>[<nul><path_prefix>...]
+          Fields:
+          - <rev_name>: This is the mercurial revision ID.  This can be any
+            string that will be understood by mercurial to identify a single
+            revision.  (For instance, this might be ".", ".^", a 40-character
+            hexadecmial hash, or a unique hash prefix, etc.)
+          - <path_prefix>: Optional directory paths, relative to the root of
+            the repository.  If any are present only the entries for files
+            under these directories are sent.  Directories outside of them
+            are not visited at all for tree manifests.
+
+        Response body format:
+          The response body is a list of manifest entries.  Each manifest entry
+          consists of:
+          - <rev_hash><tab><flag><tab><path><nul>
+
+          Entry fields:
+          - <rev_hash>: The file revision hash, as a 20-byte binary value.
+          - <tab>: A literal tab character ('\t')
+          - <flag>: The mercurial flag character.  If the mercurial flag is
+                    empty this will be omitted.  Valid mercurial flags are:
+                    'x': an executable file
+                    'l': an symlink
+                    '':  a regular file
+          - <path>: The full file path, relative to the root of the repository
+          - <nul>: a nul byte ('\0')
+
+          If the request has FLAG_COMPACT_MANIFEST set, the entries are
+          instead sent in the encoding described in CompactManifestEncoder.
+        '''
+        parts = request.body.split(b'\0')
+        rev_name = parts[0]
+        path_prefixes = parts[1:]
+        self.debug('sending manifest for revision %r', rev_name)
+        self.dump_manifest(rev_name, request, path_prefixes=path_prefixes)
+
+    @cmd(CMD_MANIFEST_ENTRIES)
+    def cmd_manifest_entries(self, request):
+        '''
+        Handler for CMD_MANIFEST_ENTRIES requests.
+
+        This looks up the manifest entries for a few paths in a given
+        revision, without sending the full manifest.
+
+        Request body format:
+        - <rev_name><nul><path><nul><path>...
+          Fields:
+          - <rev_name>: The revision name, as for CMD_MANIFEST
+          - <path>: A file path, relative to the root of the repository.
+
+        Response body format:
+          A list of manifest entries, in the same format as the CMD_MANIFEST
+          response, in the same order as the paths were listed in the
+          request.  Paths that do not exist in the revision (including
+          directories) are omitted.
+        '''
+        parts = request.body.split(b'\0')
+        rev_name = parts[0]
+        paths = parts[1:]
+        self.debug('looking up %d manifest entries for revision %r',
+                   len(paths), rev_name)
+
+        commit_node, _ = self.resolve_revision(rev_name)
+        mf = self.get_manifest(mercurial.node.hex(commit_node))
+        entries = []
+        for path in paths:
+            try:
+                hashval, flags = mf.find(path)
+            except KeyError:
+                continue
+            entries.append(b'\t'.join((hashval, flags, path + b'\0')))
+
+        self.send_chunk(request, b''.join(entries))
+
+    @cmd(CMD_CANCEL)
+    def cmd_cancel(self, request):
+        '''
+        Handler for CMD_CANCEL requests.
+
+        This asks the helper to drop a request that has not started being
+        processed yet.  The cancelled request is answered with a
+        "CancelledError" error response.  Requests can only be cancelled
+        while they are queued, which only happens when the helper runs with
+        --workers.
+
+        Request body format:
+        - <txn_id>: The transaction ID of the request to cancel, as a 32-bit
+          big-endian integer.
+
+        Response body format:
+        - A single byte: 1 if the request was cancelled, or 0 if it was not
+          queued (because it has already been processed, is being processed
+          now, or never existed).
+        '''
+        if len(request.body) != 4:
+            raise Exception('cancel request body must be 4 bytes long')
+        txn_id, = struct.unpack(b'>I', request.body)
+
+        cancelled = self.request_queue.cancel(txn_id)
+        if cancelled is not None:
+            self._drop_request(cancelled, 'CancelledError',
+                               'request cancelled')
+        self.send_chunk(request, b'\x01' if cancelled is not None else b'\x00')
+
+    @cmd(CMD_MANIFEST_DIFF)
+    def cmd_manifest_diff(self, request):
+        '''
+        Handler for CMD_MANIFEST_DIFF requests.
+
+        This request asks for the manifest entries that differ between two
+        revisions.  This allows edenfs to import a revision incrementally when
+        it has already imported a nearby revision, rather than receiving the
+        full manifest again.  The response body will be split across one or
+        more chunks.  (FLAG_MORE_CHUNKS will be set on all but the last chunk.)
+
+        Request body format:
+        - <base_rev><nul><rev>
+          Fields:
+          - <base_rev>: The revision name to compute the differences from.
+          - <nul>: a nul byte ('\0')
+          - <rev>: The revision name to compute the differences to.
+          Both revision names can be any string that will be understood by
+          mercurial to identify a single revision.
+
+        Response body format:
+          The response body is a list of manifest entries, sorted by path.
+          Each entry consists of:
+          - <status><rev_hash><tab><flag><tab><path><nul>
+
+          Entry fields:
+          - <status>: A single character describing the change:
+                      'A': the path was added in <rev>
+                      'M': the file revision hash or flag of the path changed
+                      'R': the path was removed in <rev>
+          The remaining fields have the same meaning as in CMD_MANIFEST
+          responses, and describe the entry in <rev>.  For removed paths the
+          <rev_hash> is 20 nul bytes and the <flag> is empty.
+        '''
+        base_rev, sep, rev = request.body.partition(b'\0')
+        if not sep:
+            raise Exception('manifest_diff request is missing a base revision')
+        self.debug('sending manifest diff from revision %r to %r',
+                   base_rev, rev)
+        self.dump_manifest_diff(base_rev, rev, request)
+
+    @cmd(CMD_CAT_FILE)
+    def cmd_cat_file(self, request):
+        '''
+        Handler for CMD_CAT_FILE requests.
+
+        This requests the contents for a given file.
+
+        Request body format:
+        - <rev_hash><path>
+          Fields:
+          - <rev_hash>: The file revision hash, as a 20-byte binary value.
+          - <path>: The file path, relative to the root of the repository.
+
+        Response body format:
+        - <file_contents>
+          The body consists solely of the raw file contents.
+
+        If the request has FLAG_STREAM_RESPONSE set, the file contents may be
+        split across several chunks.  (FLAG_MORE_CHUNKS will be set on all but
+        the last chunk.)  This bounds the memory used to send large files,
+        and where the storage allows it they are also read incrementally.
+        '''
+        if len(request.body) < SHA1_NUM_BYTES + 1:
+            raise Exception('cat_file request data too short')
+
+        rev_hash = request.body[:SHA1_NUM_BYTES]
+        path = request.body[SHA1_NUM_BYTES:]
+        self.debug('(pid:%s) getting contents of file %r revision %s',
+                   os.getpid(),
+                   path,
+                   binascii.hexlify(rev_hash))
+
+        if request.flags & FLAG_STREAM_RESPONSE:
+            self.send_file_stream(request, path, rev_hash)
+            return
+
+        contents = self.get_file(path, rev_hash)
+        self.send_chunk(request, contents)
+
+    def send_file_stream(self, request, path, rev_hash):
+        '''
+        Send the contents of a file across one or more chunks of at most
+        self.cat_file_chunk_size bytes.
+        '''
+        # Hold back each piece until we know whether it is the last one.
+        pending = b''
+        for n, piece in enumerate(self.iter_file_data(
+                path, rev_hash, self.cat_file_chunk_size)):
+            if n > 0:
+                self.send_chunk(request, pending, is_last=False)
+            pending = piece
+        self.send_chunk(request, pending, is_last=True)
+
+    @cmd(CMD_CAT_FILE_DELTA)
+    def cmd_cat_file_delta(self, request):
+        '''
+        Handler for CMD_CAT_FILE_DELTA requests.
+
+        This requests the contents of a file as a delta against another
+        revision of the same file that the sender already has.  The full
+        contents are sent instead if the base revision is not available, if
+        either revision is larger than the edenfs.deltamaxfilesize setting,
+        or if the delta would not be smaller.
+
+        Request body format:
+        - <rev_hash><base_rev_hash><path>
+          Fields:
+          - <rev_hash>: The file revision hash, as a 20-byte binary value.
+          - <base_rev_hash>: The file revision hash of the base version, as a
+                             20-byte binary value.
+          - <path>: The file path, relative to the root of the repository.
+
+        Response body format:
+        - <type><data>
+          Fields:
+          - <type>: A single byte: DELTA_TYPE_FULL if <data> is the raw file
+                    contents, or DELTA_TYPE_MDIFF if <data> is a delta in
+                    mercurial's binary patch format, to be applied to the
+                    contents of the base revision.
+        '''
+        if len(request.body) < 2 * SHA1_NUM_BYTES + 1:
+            raise Exception('cat_file_delta request data too short')
+
+        rev_hash = request.body[:SHA1_NUM_BYTES]
+        base_hash = request.body[SHA1_NUM_BYTES:2 * SHA1_NUM_BYTES]
+        path = request.body[2 * SHA1_NUM_BYTES:]
+        self.debug('getting delta of file %r revision %s against %s', path,
+                   binascii.hexlify(rev_hash), binascii.hexlify(base_hash))
+
+        contents = self.get_file(path, rev_hash)
+        delta = self.get_file_delta(path, base_hash, rev_hash, contents)
+        if delta is not None and len(delta) < len(contents):
+            self.send_chunk(request, DELTA_TYPE_MDIFF + delta)
+        else:
+            self.send_chunk(request, DELTA_TYPE_FULL + contents)
+
+    def get_file_delta(self, path, base_hash, rev_hash, contents):
+        '''
+        Compute a delta from the base revision of a file to the given
+        revision, whose contents are passed in.
+
+        Returns None if the base revision is not available locally, or if
+        either revision is too large to diff.  The base revision is never
+        fetched from a remotefilelog server, since that would cost more than
+        sending the full contents.
+        '''
+        if self._too_large_to_diff(contents):
+            self.debug('not computing delta of %r: file is too large', path)
+            return None
+        if not self._is_file_local(path, base_hash):
+            self.debug('not computing delta of %r: base revision %s is not '
+                       'available locally', path, binascii.hexlify(base_hash))
+            return None
+        try:
+            base_contents = self.get_file(path, base_hash)
+        except Exception as ex:
+            self.debug('base revision %s of %r is not available: %s',
+                       binascii.hexlify(base_hash), path, ex)
+            return None
+        if self._too_large_to_diff(base_contents):
+            self.debug('not computing delta of %r: base revision %s is too '
+                       'large', path, binascii.hexlify(base_hash))
+            return None
+
+        delta = self._get_stored_delta(path, base_hash, base_contents,
+                                       rev_hash, contents)
+        if delta is None:
+            delta = mercurial.mdiff.textdiff(base_contents, contents)
+        return delta
+
+    def _is_file_local(self, path, rev_hash):
+        '''
+        Return True if the contents of a file revision can be read without
+        contacting a remotefilelog server.
+        '''
+        if self.blob_cache.get(rev_hash) is not None:
+            return True
+        if not hasattr(self.repo, 'fileservice'):
+            # This repo isn't using remotefilelog, so all file data is local.
+            return True
+        try:
+            missing = self.repo.contentstore.getmissing(
+                [(path, mercurial.node.hex(rev_hash))])
+        except Exception:
+            logging.debug('unable to check if %r is available locally', path,
+                          exc_info=True)
+            return False
+        return not missing
+
+    def _too_large_to_diff(self, contents):
+        return (self.delta_max_file_size > 0 and
+                len(contents) > self.delta_max_file_size)
+
+    def _get_stored_delta(self, path, base_hash, base_contents, rev_hash,
+                          contents):
+        '''
+        Ask a revlog-backed file log for the delta between two revisions,
+        which it can return without recomputing it when the revlog stores
+        exactly that delta.
+
+        Returns None if the delta of the stored revision texts may differ
+        from the delta of the file contents: this is the case for
+        remotefilelog storage, revisions with copy metadata, and revisions
+        whose stored text is transformed by a flag processor such as lfs.
+        '''
+        flog = self.repo.file(path)
+        if not isinstance(flog, mercurial.revlog.revlog):
+            return None
+        try:
+            base_rev = flog.rev(base_hash)
+            rev = flog.rev(rev_hash)
+        except mercurial.error.LookupError:
+            return None
+        for r, node, data in ((base_rev, base_hash, base_contents),
+                              (rev, rev_hash, contents)):
+            # Stored texts carry a metadata header if the file was copied, or
+            # if its contents happen to start with the header marker.
+            if (flog.flags(r) or data.startswith(b'\1\n') or
+                    flog.renamed(node)):
+                return None
+        return flog.revdiff(base_rev, rev)
+
+    @cmd(CMD_FILE_METADATA)
+    def cmd_file_metadata(self, request):
+        '''
+        Handler for CMD_FILE_METADATA requests.
+
+        This requests the size and SHA-1 hash of a file's contents, without
+        the contents themselves.  The result is cached per file revision.
+
+        Request body format:
+        - <rev_hash><path>
+          Fields:
+          - <rev_hash>: The file revision hash, as a 20-byte binary value.
+          - <path>: The file path, relative to the root of the repository.
+
+        Response body format:
+        - <size><content_sha1>
+          Fields:
+          - <size>: The file size, as a 64-bit big-endian integer.
+          - <content_sha1>: The SHA-1 hash of the file contents, as a 20-byte
+                            binary value.
+        '''
+        if len(request.body) < SHA1_NUM_BYTES + 1:
+            raise Exception('file_metadata request data too short')
+
+        rev_hash = request.body[:SHA1_NUM_BYTES]
+        path = request.body[SHA1_NUM_BYTES:]
+        self.debug('getting metadata of file %r revision %s',
+                   path, binascii.hexlify(rev_hash))
 
-        # Return True to indicate that we should continue serving
-        return True
+        self.send_chunk(request, self.get_file_metadata(path, rev_hash))
 
-    @cmd(CMD_MANIFEST)
-    def cmd_manifest(self, request):
+    def get_file_metadata(self, path, rev_hash):
         '''
-        Handler for CMD_MANIFEST requests.
+        Return the size and SHA-1 of a file's contents, encoded in the
+        CMD_FILE_METADATA response format.
+        '''
+        metadata = self.metadata_cache.get(rev_hash)
+        if metadata is None:
+            size = 0
+            sha1 = hashlib.sha1()
+            for piece in self.iter_file_data(path, rev_hash,
+                                             self.cat_file_chunk_size):
+                size += len(piece)
+                sha1.update(piece)
+            metadata = struct.pack(b'>Q', size) + sha1.digest()
+            self.metadata_cache.put(rev_hash, metadata)
+        return metadata
+
+    @cmd(CMD_CAT_FILE_BATCH)
+    def cmd_cat_file_batch(self, request):
+        '''
+        Handler for CMD_CAT_FILE_BATCH requests.
 
-        This request asks for the full mercurial manifest contents for a given
-        revision.  The response body will be split across one or more chunks.
-        (FLAG_MORE_CHUNKS will be set on all but the last chunk.)
+        This requests the contents of several files in a single round trip.
+        If the repository uses remotefilelog, all of the requested files are
+        prefetched with a single remote request before any data is sent.
+
+        The response body will be split across one or more chunks.
+        (FLAG_MORE_CHUNKS will be set on all but the last chunk.)  Each chunk
+        contains one or more complete file entries.
 
         Request body format:
-        - Revision name (string)
-          This is the mercurial revision ID.  This can be any string that will
-          be understood by mercurial to identify a single revision.  (For
-          instance, this might be ".", ".^", a 40-character hexadecmial hash,
-          or a unique hash prefix, etc.)
+        - <num_files><file_entry>...
+          Fields:
+          - <num_files>: The number of files, as a 32-bit big-endian integer.
+          - <file_entry>: <rev_hash><path_length><path>
+            - <rev_hash>: The file revision hash, as a 20-byte binary value.
+            - <path_length>: The path length, as a 32-bit big-endian integer.
+            - <path>: The file path, relative to the root of the repository.
 
         Response body format:
-          The response body is a list of manifest entries.  Each manifest entry
-          consists of:
-          - <rev_hash><tab><flag><tab><path><nul>
-
-          Entry fields:
-          - <rev_hash>: The file revision hash, as a 20-byte binary value.
-          - <tab>: A literal tab character ('\t')
-          - <flag>: The mercurial flag character.  If the mercurial flag is
-                    empty this will be omitted.  Valid mercurial flags are:
-                    'x': an executable file
-                    'l': an symlink
-                    '':  a regular file
-          - <path>: The full file path, relative to the root of the repository
-          - <nul>: a nul byte ('\0')
+        - A list of <length><file_contents> entries, in the same order as the
+          files were listed in the request.
+          Fields:
+          - <length>: The file length, as a 32-bit big-endian integer.
+          - <file_contents>: The raw file contents.
         '''
-        rev_name = request.body
-        self.debug('sending manifest for revision %r', rev_name)
-        self.dump_manifest(rev_name, request)
+        files = self._parse_file_list(request.body)
+        self.debug('getting contents of %d files', len(files))
 
-    @cmd(CMD_CAT_FILE)
-    def cmd_cat_file(self, request):
+        self.prefetch_files(files)
+
+        def gen_entries():
+            for path, rev_hash in files:
+                contents = self.get_file(path, rev_hash)
+                yield struct.pack(b'>I', len(contents)) + contents
+
+        self.send_entries(request, gen_entries())
+
+    @cmd(CMD_CACHE_STATS)
+    def cmd_cache_stats(self, request):
         '''
-        Handler for CMD_CAT_FILE requests.
+        Handler for CMD_CACHE_STATS requests.
 
-        This requests the contents for a given file.
+        This requests the hit, miss and eviction counters of the helper's
+        in-memory caches.
 
         Request body format:
-        - <rev_hash><path>
-          Fields:
-          - <rev_hash>: The file revision hash, as a 20-byte binary value.
-          - <path>: The file path, relative to the root of the repository.
+        - The request body is ignored.
 
         Response body format:
-        - <file_contents>
-          The body consists solely of the raw file contents.
+        - A list of counters, in the format described in encode_counters()
         '''
-        if len(request.body) < SHA1_NUM_BYTES + 1:
-            raise Exception('cat_file request data too short')
+        self.send_chunk(request, encode_counters(self.get_cache_counters()))
 
-        rev_hash = request.body[:SHA1_NUM_BYTES]
-        path = request.body[SHA1_NUM_BYTES:]
-        self.debug('(pid:%s) getting contents of file %r revision %s',
-                   os.getpid(),
-                   path,
-                   binascii.hexlify(rev_hash))
+    def get_cache_counters(self):
+        return (self.blob_cache.get_counters() +
+                self.metadata_cache.get_counters() +
+                self.revision_cache.get_counters() +
+                self.negative_cache.get_counters())
 
-        contents = self.get_file(path, rev_hash)
-        self.send_chunk(request, contents)
+    @cmd(CMD_STATS)
+    def cmd_stats(self, request):
+        '''
+        Handler for CMD_STATS requests.
+
+        This requests the helper's request statistics: counts by command and
+        outcome, latency histograms, bytes sent, retry counts and the number
+        of requests answered by coalescing them with an identical request,
+        along with the cache counters returned by CMD_CACHE_STATS.
+
+        Request body format:
+        - The request body is ignored.
+
+        Response body format:
+        - A list of counters, in the format described in encode_counters()
+        '''
+        counters = self.stats.get_counters()
+        counters.extend(self.coalescer.get_counters())
+        counters.extend(self.get_cache_counters())
+        counters.append(('chunk_size.target_bytes',
+                         self.chunk_sizer.target_bytes))
+        self.send_chunk(request, encode_counters(counters))
+
+    def _parse_file_list(self, data):
+        '''
+        Parse a list of (path, rev_hash) tuples, in the format used by the
+        CMD_CAT_FILE_BATCH and CMD_FETCH_TREES request bodies.
+        '''
+        if len(data) < 4:
+            raise Exception('file list too short: len=%d' % len(data))
+        num_files, = struct.unpack_from(b'>I', data)
+        offset = 4
+
+        files = []
+        for _ in range(num_files):
+            if len(data) < offset + SHA1_NUM_BYTES + 4:
+                raise Exception('file list truncated after %d of %d entries'
+                                % (len(files), num_files))
+            rev_hash = data[offset:offset + SHA1_NUM_BYTES]
+            offset += SHA1_NUM_BYTES
+            path_len, = struct.unpack_from(b'>I', data, offset)
+            offset += 4
+            path = data[offset:offset + path_len]
+            if len(path) < path_len:
+                raise Exception('file list truncated after %d of %d entries'
+                                % (len(files), num_files))
+            offset += path_len
+            files.append((path, rev_hash))
+
+        return files
 
     @cmd(CMD_MANIFEST_NODE_FOR_COMMIT)
     def cmd_manifest_node_for_commit(self, request):
@@ -411,6 +2509,77 @@ class HgServer(object):
 
         self.send_chunk(request, node)
 
+    @cmd(CMD_MANIFEST_NODES_FOR_COMMITS)
+    def cmd_manifest_nodes_for_commits(self, request):
+        '''
+        Handler for CMD_MANIFEST_NODES_FOR_COMMITS requests.
+
+        This is a batch form of CMD_MANIFEST_NODE_FOR_COMMIT.  If any of the
+        revisions cannot be resolved an error response is sent instead.
+
+        Request body format:
+        - A list of revision names, separated by nul bytes ('\0').
+          Each revision name can be anything accepted by
+          CMD_MANIFEST_NODE_FOR_COMMIT.
+
+        Response body format:
+          The manifest nodes, as 20-byte binary values, in the same order as
+          the revisions were listed in the request.
+        '''
+        rev_names = request.body.split(b'\0')
+        self.debug('resolving manifest nodes for %d revisions', len(rev_names))
+        try:
+            nodes = [self.get_manifest_node(rev_name)
+                     for rev_name in rev_names]
+        except mercurial.error.RepoError as ex:
+            self.send_exception(request, ex)
+            return
+
+        self.send_chunk(request, b''.join(nodes))
+
+    @cmd(CMD_PREFETCH)
+    def cmd_prefetch(self, request):
+        '''
+        Handler for CMD_PREFETCH requests.
+
+        This requests that the contents of all files in a set of revisions be
+        fetched from the remotefilelog server into the local cache, so that
+        later CMD_CAT_FILE requests for them do not need to go to the server.
+        Progress is reported in a series of response chunks.
+        (FLAG_MORE_CHUNKS will be set on all but the last chunk.)
+
+        Request body format:
+        - <revset>[<nul><path_prefix>]...
+          Fields:
+          - <revset>: A mercurial revset, e.g. "." or "draft()"
+          - <path_prefix>: If any path prefixes are given, only files under
+                           these directories are fetched.
+
+        Response body format:
+        - <num_done><num_total>
+          Fields:
+          - <num_done>: The number of files processed so far, as a 64-bit
+                        big-endian integer.
+          - <num_total>: The total number of files to process, as a 64-bit
+                         big-endian integer.
+          The final chunk has <num_done> equal to <num_total>.
+        '''
+        parts = request.body.split(b'\0')
+        rev = parts[0]
+        path_prefixes = [prefix for prefix in parts[1:] if prefix]
+        self.debug('prefetching files for revisions %r under %r',
+                   rev, path_prefixes)
+
+        def report_progress(num_done, num_total):
+            if num_done < num_total:
+                self.send_chunk(request,
+                                struct.pack(b'>QQ', num_done, num_total),
+                                is_last=False)
+
+        num_total = self.prefetch(rev, path_prefixes,
+                                  progress_callback=report_progress)
+        self.send_chunk(request, struct.pack(b'>QQ', num_total, num_total))
+
     @cmd(CMD_FETCH_TREE)
     def cmd_fetch_tree(self, request):
         if len(request.body) < SHA1_NUM_BYTES:
@@ -425,12 +2594,182 @@ class HgServer(object):
         self.fetch_tree(path, manifest_node)
         self.send_chunk(request, b'')
 
-    def fetch_tree(self, path, manifest_node):
+    @cmd(CMD_FETCH_TREE_DEPTH)
+    def cmd_fetch_tree_depth(self, request):
+        '''
+        Handler for CMD_FETCH_TREE_DEPTH requests.
+
+        This is like CMD_FETCH_TREE, but only fetches the trees down to the
+        specified depth below the requested path before responding.  When the
+        helper runs with at least two --workers, the rest of the subtree is
+        then fetched in the background, when no other requests are waiting.
+        Otherwise the rest is only fetched when it is requested.
+
+        If the installed treemanifest extension does not support depth-limited
+        fetches, the entire subtree is fetched before responding, exactly as
+        for CMD_FETCH_TREE.
+
+        Request body format:
+        - <depth><manifest_node><path>
+          Fields:
+          - <depth>: The number of directory levels to fetch, as a 32-bit
+                     big-endian integer.  A depth of 1 fetches just the tree
+                     for <path> itself.
+          - <manifest_node>: The manifest node for <path>, as a 20-byte
+                             binary value.
+          - <path>: The directory path, relative to the root of the
+                    repository.
+
+        Response body format:
+        - The response body is empty.
+        '''
+        if len(request.body) < 4 + SHA1_NUM_BYTES:
+            raise Exception('fetch_tree_depth request data too short: len=%d'
+                            % len(request.body))
+
+        depth, = struct.unpack_from(b'>I', request.body)
+        manifest_node = request.body[4:4 + SHA1_NUM_BYTES]
+        path = request.body[4 + SHA1_NUM_BYTES:]
+        self.debug('fetching tree for path %r manifest node %s to depth %d',
+                   path, binascii.hexlify(manifest_node), depth)
+
+        if self.fetch_tree(path, manifest_node, depth=depth):
+            self.queue_background_fetch_tree(path, manifest_node)
+        self.send_chunk(request, b'')
+
+    @cmd(CMD_FETCH_TREES)
+    def cmd_fetch_trees(self, request):
+        '''
+        Handler for CMD_FETCH_TREES requests.
+
+        This is a batch form of CMD_FETCH_TREE: it fetches the trees for
+        several (path, manifest node) pairs, and all trees below them, from
+        the server with as few round trips as possible.
+
+        Request body format:
+        - <num_trees><tree_entry>...
+          Fields:
+          - <num_trees>: The number of trees, as a 32-bit big-endian integer.
+          - <tree_entry>: <manifest_node><path_length><path>
+            - <manifest_node>: The manifest node for <path>, as a 20-byte
+                               binary value.
+            - <path_length>: The path length, as a 32-bit big-endian integer.
+            - <path>: The directory path, relative to the root of the
+                      repository.
+
+        Response body format:
+        - The response body is empty.
+        '''
+        trees = self._parse_file_list(request.body)
+        self.debug('fetching %d trees', len(trees))
+        if trees:
+            self.fetch_trees(trees)
+        self.send_chunk(request, b'')
+
+    @cmd(CMD_GET_TREE)
+    def cmd_get_tree(self, request):
+        '''
+        Handler for CMD_GET_TREE requests.
+
+        This requests the entries of a single tree manifest node, read from
+        the local treemanifest packs.  If the tree is not available locally
+        it is first fetched from the server.
+
+        Request body format:
+        - <manifest_node><path>
+          Fields:
+          - <manifest_node>: The manifest node for <path>, as a 20-byte binary
+                             value.
+          - <path>: The directory path, relative to the root of the
+                    repository.  This is empty for the root directory.
+
+        Response body format:
+          A list of tree entries, in the same format as the CMD_MANIFEST
+          response entries, except that <path> is the entry's name within the
+          directory, and <flag> is 't' for subdirectories.  For a
+          subdirectory <rev_hash> is its manifest node.
+        '''
+        if len(request.body) < SHA1_NUM_BYTES:
+            raise Exception('get_tree request data too short: len=%d' %
+                            len(request.body))
+
+        manifest_node = request.body[:SHA1_NUM_BYTES]
+        path = request.body[SHA1_NUM_BYTES:]
+        self.debug('getting tree for path %r manifest node %s',
+                   path, binascii.hexlify(manifest_node))
+
+        data = self.get_tree_data(path, manifest_node)
+        entries = []
+        for line in data.splitlines():
+            name, rest = line.split(b'\0', 1)
+            hashval = binascii.unhexlify(rest[:2 * SHA1_NUM_BYTES])
+            flags = rest[2 * SHA1_NUM_BYTES:]
+            entries.append(b'\t'.join((hashval, flags, name + b'\0')))
+        self.send_chunk(request, b''.join(entries))
+
+    def get_tree_data(self, path, manifest_node):
+        '''
+        Return the raw text of a tree manifest node, fetching it from the
+        server if it is not in the local packs.
+        '''
+        store = getattr(self.repo.svfs, 'manifestdatastore', None)
+        if store is None:
+            raise Exception('treemanifest not enabled in this repository')
+
+        try:
+            return store.get(path, manifest_node)
+        except KeyError:
+            pass
+
+        # Only fetch this one tree if possible, since the caller will ask
+        # for the subdirectories it needs separately.
+        self.fetch_tree(path, manifest_node, depth=1)
+        # fetch_tree() may have re-opened the repository.
+        self._refresh_packs()
+        return self.repo.svfs.manifestdatastore.get(path, manifest_node)
+
+    def queue_background_fetch_tree(self, path, manifest_node):
+        if not self.request_queue.accepts_background():
+            return
+        task = BackgroundTask(
+            key=(CMD_FETCH_TREE, path, manifest_node),
+            func=lambda: self.fetch_tree(path, manifest_node))
+        if not self.request_queue.put_background(task):
+            self.debug('background queue full: not fetching the remainder of '
+                       'tree %r manifest node %s', path,
+                       binascii.hexlify(manifest_node))
+
+    def fetch_tree(self, path, manifest_node, depth=None):
+        '''
+        Fetch the tree data for the specified path and manifest node, and
+        all trees below it, from the server.
+
+        If depth is not None, fetch only the trees that many levels deep,
+        if the treemanifest extension supports it.  Returns True if a
+        depth-limited fetch was performed.
+        '''
+        return self.fetch_trees([(path, manifest_node)], depth=depth)
+
+    def fetch_trees(self, trees, depth=None):
+        '''
+        Fetch the tree data for a list of (path, manifest_node) tuples, and
+        all trees below them, from the server.
+
+        depth and the return value are as for fetch_tree().
+        '''
         if self.treemanifest is None:
             raise Exception('treemanifest not enabled in this repository')
 
+        if depth is not None and not self._tree_fetch_supports_depth():
+            depth = None
+
+        with self.remember_failure(('tree', tuple(trees), depth)):
+            self._fetch_trees_with_retry(trees, depth)
+        return depth is not None
+
+    def _fetch_trees_with_retry(self, trees, depth):
         try:
-            self._fetch_tree_impl(path, manifest_node)
+            self._fetch_trees_impl(trees, depth)
         except Exception:
             # Ugh.  Mercurial sometimes throws spurious KeyErrors
             # if this tree was created since we first initialized our
@@ -439,132 +2778,382 @@ class HgServer(object):
             # These errors come from the server-side; there doesn't seem to be
             # a good way to force the server to re-read the data other than
             # recreating our repo object.
-            self.repo = self._open_repo()
-            self._fetch_tree_impl(path, manifest_node)
-
-    def _fetch_tree_impl(self, path, manifest_node):
-        mfnodes = set([manifest_node])
+            #
+            # Only do this once per change to the local repository, though,
+            # so that repeated requests for a tree that really is missing do
+            # not re-open the repository every time.
+            if not self.reopen_repo_if_changed('fetch_tree'):
+                raise
+            self._fetch_trees_impl(trees, depth)
+
+    def _fetch_trees_impl(self, trees, depth=None):
         base_mfnodes = set()
 
         # The directories parameter isn't actually supported and
         # must always be an empty list.
         directories = []
 
-        # It would be nice to initially only fetch the one tree that we need
-        # immediately, and fetch the rest of the subtree later, in the
-        # background.  Unfortunately the wire protocol API does not support a
-        # mechanism to do this yet.  In the future it's probably worth adding a
-        # "depth" parameter requesting data only down to a specific depth.
+        # CMD_FETCH_TREE_DEPTH passes a depth here so that we initially only
+        # fetch the trees that are needed immediately, and fetch the rest of
+        # the subtree later, in the background.
+        kwargs = {}
+        if depth is not None:
+            kwargs['depth'] = depth
 
         # Newer mercurial releases have self.repo.prefetchtrees()
         # Older mercurial releases have self.treemanifest._prefetchtrees()
         if mercurial.util.safehasattr(self.repo, 'prefetchtrees'):
             # TODO: repo.prefetchtrees() does not accept a path
-            self.repo.prefetchtrees(mfnodes)
+            mfnodes = set(node for _path, node in trees)
+            self.repo.prefetchtrees(mfnodes, **kwargs)
+        else:
+            # _prefetchtrees() fetches the trees for a single path, so make
+            # one call for each distinct path.
+            mfnodes_by_path = collections.OrderedDict()
+            for path, node in trees:
+                mfnodes_by_path.setdefault(path, set()).add(node)
+            for path, mfnodes in mfnodes_by_path.items():
+                self.treemanifest._prefetchtrees(self.repo, path, mfnodes,
+                                                 base_mfnodes, directories,
+                                                 **kwargs)
+
+    def _tree_fetch_supports_depth(self):
+        if mercurial.util.safehasattr(self.repo, 'prefetchtrees'):
+            func = self.repo.prefetchtrees
         else:
-            self.treemanifest._prefetchtrees(self.repo, path, mfnodes,
-                                             base_mfnodes, directories)
+            func = self.treemanifest._prefetchtrees
+        return accepts_argument(func, 'depth')
 
     def send_chunk(self, request, data, is_last=True):
+        '''
+        Send a response chunk for the given request.
+
+        Returns the number of seconds spent writing the chunk to the pipe.
+        '''
         flags = 0
         if not is_last:
             flags |= FLAG_MORE_CHUNKS
-        self._send_chunk(request.txn_id, command=CMD_RESPONSE,
-                         flags=flags, data=data)
+        if ((request.flags & FLAG_ZLIB_COMPRESSED) and
+                len(data) >= self.compression_threshold):
+            compressed = zlib.compress(data, self.compression_level)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= FLAG_ZLIB_COMPRESSED
+        request.bytes_sent += HEADER_SIZE + len(data)
+        request.record_chunk(flags, data)
+        return self._send_chunk(request.txn_id, command=CMD_RESPONSE,
+                                flags=flags, data=data)
 
     def send_exception(self, request, exc):
         self.send_error(request, type(exc).__name__, str(exc))
 
     def send_error(self, request, error_type, message):
-        txn_id = 0
-        if request is not None:
-            txn_id = request.txn_id
-
         data = b''.join([
             struct.pack(b'>I', len(error_type)),
             error_type,
             struct.pack(b'>I', len(message)),
             message,
         ])
+
+        txn_id = 0
+        if request is not None:
+            txn_id = request.txn_id
+            request.bytes_sent += HEADER_SIZE + len(data)
+            request.record_chunk(FLAG_ERROR, data)
         self._send_chunk(txn_id, command=CMD_RESPONSE,
                          flags=FLAG_ERROR, data=data)
 
     def _send_chunk(self, txn_id, command, flags, data):
         header = struct.pack(HEADER_FORMAT, txn_id, command, flags,
                              len(data))
-        self.out_file.write(header)
-        self.out_file.write(data)
-        self.out_file.flush()
+        with self._send_lock:
+            start = time.time()
+            write_all(self.out_fd, [header, data])
+            return time.time() - start
 
-    def dump_manifest(self, rev, request):
+    def dump_manifest(self, rev, request, path_prefixes=None):
         '''
         Send the manifest data.
+
+        If path_prefixes is non-empty only the entries for files under those
+        directories are sent.
         '''
         start = time.time()
+        commit_node, manifest_node = self.resolve_revision(rev)
+        matcher = self._path_prefix_matcher(path_prefixes)
+        if request.flags & FLAG_COMPACT_MANIFEST:
+            encoding = 'compact'
+            encoder = CompactManifestEncoder()
+        else:
+            encoding = None
+            encoder = None
+
+        # The manifest cache only holds full manifests.
+        use_cache = self.manifest_cache is not None and matcher is None
+        if use_cache:
+            cached_chunks = self.manifest_cache.get_chunks(manifest_node,
+                                                           encoding)
+            if cached_chunks is not None:
+                self.send_chunks(request, cached_chunks)
+                self.debug('sent cached manifest %s in %s seconds',
+                           mercurial.node.hex(manifest_node),
+                           time.time() - start)
+                return
+
+        # Look up the commit by its hash, so that we send the manifest that
+        # was resolved above even if rev is a name that has since moved.
+        mf = self.get_manifest(mercurial.node.hex(commit_node))
+        if matcher is not None:
+            mf = mf.matches(matcher)
+
+        # Only open the cache file once the manifest has been loaded, so that
+        # a failed lookup does not leave a temporary file behind.
+        cache_writer = None
+        if use_cache:
+            cache_writer = self.manifest_cache.open_writer(manifest_node,
+                                                           encoding)
+
+        if encoder is not None:
+            entries = mf.iterentries()
+        else:
+            # Construct the entry data using join(), since that is relatively
+            # fast compared to other ways of constructing python strings.
+            entries = (b'\t'.join((hashval, flags, path + b'\0'))
+                       for path, hashval, flags in mf.iterentries())
         try:
-            ctx = mercurial.scmutil.revsingle(self.repo, rev)
-            mf = ctx.manifest()
+            num_paths = self.send_entries(request, entries,
+                                          cache_writer=cache_writer,
+                                          encoder=encoder)
         except Exception:
-            # The mercurial call may fail with a "no node" error if this
-            # revision in question has added to the repository after we
-            # originally opened it.  Invalidate the repository and try again,
-            # in case our cached repo data is just stale.
-            self.repo.invalidate(clearfilecache=True)
-            ctx = mercurial.scmutil.revsingle(self.repo, rev)
-            mf = ctx.manifest()
-
-        # How many paths to send in each chunk
-        # Empirically, 100 seems like a decent number.
-        # Too small and we pay a cost for doing too many small writes.
-        # Too big and the C++ code is idle while it waits for us to build a
-        # chunk, and then we fill up the pipe writing the data out, and have
-        # to wait for it to be processed before we can start building the next
-        # chunk.
-        MANIFEST_PATHS_PER_CHUNK = 100
-
-        chunked_paths = []
-        num_paths = 0
-        for path, hashval, flags in mf.iterentries():
-            # Construct the chunk data using join(), since that is relatively
-            # fast compared to other ways of constructing python strings.
-            entry = b'\t'.join((hashval, flags, path + b'\0'))
-            if len(chunked_paths) >= MANIFEST_PATHS_PER_CHUNK:
-                num_paths += len(chunked_paths)
-                self.send_chunk(request, b''.join(chunked_paths),
-                                is_last=False)
-                chunked_paths = [entry]
-            else:
-                chunked_paths.append(entry)
-
-        num_paths += len(chunked_paths)
-        self.send_chunk(request, b''.join(chunked_paths), is_last=True)
+            if cache_writer is not None:
+                cache_writer.abort()
+            raise
+        if cache_writer is not None:
+            cache_writer.commit()
         self.debug('sent manifest with %d paths in %s seconds',
                    num_paths, time.time() - start)
 
+    def dump_manifest_diff(self, base_rev, rev, request):
+        '''
+        Send the manifest entries that differ between base_rev and rev.
+        '''
+        start = time.time()
+        base_mf = self.get_manifest(base_rev)
+        mf = self.get_manifest(rev)
+
+        # diff() returns a dictionary of
+        #   path --> ((base_node, base_flags), (node, flags))
+        # where the node is None if the path does not exist on that side.
+        diff = base_mf.diff(mf)
+
+        def gen_entries():
+            for path in sorted(diff):
+                (base_node, base_flags), (node, flags) = diff[path]
+                if node is None:
+                    yield b''.join((b'R', mercurial.node.nullid, b'\t\t',
+                                    path, b'\0'))
+                else:
+                    status = b'A' if base_node is None else b'M'
+                    yield b''.join((status, node, b'\t', flags, b'\t',
+                                    path, b'\0'))
+
+        num_paths = self.send_entries(request, gen_entries())
+        self.debug('sent manifest diff with %d paths in %s seconds',
+                   num_paths, time.time() - start)
+
+    def send_entries(self, request, entries, cache_writer=None, encoder=None):
+        '''
+        Send an iterable of entry strings as the response to a request, split
+        across one or more chunks.  Each chunk contains only complete entries,
+        and is sized by self.chunk_sizer.
+
+        If cache_writer is not None, each chunk is also passed to its
+        add_chunk() method.
+
+        If encoder is not None, entries is an iterable of values to pass to
+        encoder.encode() to produce the entry strings, and encoder.reset() is
+        called at the start of each chunk after the first.
+
+        Returns the number of entries sent.
+        '''
+        sizer = self.chunk_sizer
+        chunk_sizes = []
+        chunked_entries = []
+        chunk_len = 0
+        num_entries = 0
+        build_start = time.time()
+        for item in entries:
+            entry = item if encoder is None else encoder.encode(item)
+            if chunked_entries and chunk_len + len(entry) > sizer.target_bytes:
+                num_entries += len(chunked_entries)
+                chunk_sizes.append(chunk_len)
+                chunk = b''.join(chunked_entries)
+                if cache_writer is not None:
+                    cache_writer.add_chunk(chunk)
+                build_time = time.time() - build_start
+                write_time = self.send_chunk(request, chunk, is_last=False)
+                sizer.record(build_time, write_time)
+                chunked_entries = []
+                chunk_len = 0
+                build_start = time.time()
+                if encoder is not None:
+                    encoder.reset()
+                    entry = encoder.encode(item)
+            chunked_entries.append(entry)
+            chunk_len += len(entry)
+
+        num_entries += len(chunked_entries)
+        chunk_sizes.append(chunk_len)
+        chunk = b''.join(chunked_entries)
+        if cache_writer is not None:
+            cache_writer.add_chunk(chunk)
+        self.send_chunk(request, chunk, is_last=True)
+        self.debug('sent %d entries in %d chunks: min=%d avg=%d max=%d bytes',
+                   num_entries, len(chunk_sizes), min(chunk_sizes),
+                   sum(chunk_sizes) // len(chunk_sizes), max(chunk_sizes))
+        return num_entries
+
+    def send_chunks(self, request, chunks):
+        '''
+        Send a sequence of pre-built chunks as the response to a request.
+        '''
+        num_chunks = len(chunks)
+        for n, chunk in enumerate(chunks):
+            self.send_chunk(request, chunk, is_last=(n + 1 == num_chunks))
+
+    def get_manifest(self, rev):
+        return self.get_changectx(rev).manifest()
+
     def get_manifest_node(self, rev):
+        return self.resolve_revision(rev)[1]
+
+    def resolve_revision(self, rev):
+        '''
+        Resolve a revision name to a (commit_node, manifest_node) tuple.
+
+        Results are kept in the revision cache.  A full 40-character commit
+        hash always refers to the same commit, so its entry never needs to be
+        invalidated.  The meaning of any other name (".", a bookmark, a hash
+        prefix, etc.) can change, so its entry is only used while the
+        changelog, dirstate, bookmarks and remote names are unchanged.
+        '''
+        cache_key = self._revision_cache_key(rev)
+        value = self.revision_cache.get(cache_key)
+        if value is None:
+            signature = self._thread_state.signature
+            if (isinstance(cache_key, tuple) and
+                    cache_key[1:] != (signature.changelog, signature.names,
+                                      signature.dirstate)):
+                # The changelog, bookmarks, remote names or dirstate have
+                # changed on disk since this thread's repository object last
+                # read them.  Refresh it first, so that the new entry does not
+                # come from stale data.
+                self.refresh_repo_if_changed('resolve_revision')
+            ctx = self.get_changectx(rev)
+            value = ctx.node() + ctx.manifestnode()
+            # The key was computed from the on-disk state before the lookup,
+            # so it can only be older than the data stored under it.
+            self.revision_cache.put(cache_key, value)
+        return value[:SHA1_NUM_BYTES], value[SHA1_NUM_BYTES:]
+
+    def _revision_cache_key(self, rev):
+        if HEX_HASH_RE.match(rev):
+            return rev.lower()
+        repo = self.repo
+        return (rev, self._changelog_signature(repo),
+                self._names_signature(repo),
+                stat_signature(repo.vfs.join(b'dirstate')))
+
+    def get_changectx(self, rev):
+        # The revision cache key also covers the dirstate, bookmarks and
+        # remote names for revision names whose meaning depends on them.
+        with self.remember_failure(('rev', self._revision_cache_key(rev))):
+            return self._get_changectx_with_retry(rev)
+
+    def _get_changectx_with_retry(self, rev):
         try:
-            ctx = mercurial.scmutil.revsingle(self.repo, rev)
-            return ctx.manifestnode()
+            return mercurial.scmutil.revsingle(self.repo, rev)
         except Exception:
             # The mercurial call may fail with a "no node" error if this
             # revision in question has added to the repository after we
-            # originally opened it.  Invalidate the repository and try again,
-            # in case our cached repo data is just stale.
-            #
-            # clearfilecache=True is necessary so that mercurial will open
-            # 00changelog.i.a if it exists now instead of just using
-            # 00changelog.i  The .a file contains pending commit data if a
-            # transaction is in progress.
-            self.repo.invalidate(clearfilecache=True)
-            ctx = mercurial.scmutil.revsingle(self.repo, rev)
-            return ctx.manifestnode()
+            # originally opened it.  If the repository has changed on disk,
+            # refresh it and try again, in case our cached repo data is just
+            # stale.
+            if not self.refresh_repo_if_changed('get_changectx'):
+                raise
+            return mercurial.scmutil.revsingle(self.repo, rev)
 
     def get_file(self, path, rev_hash):
+        contents = self.blob_cache.get(rev_hash)
+        if contents is None:
+            contents = self._get_file_from_repo(path, rev_hash)
+            self.blob_cache.put(rev_hash, contents)
+        return contents
+
+    def iter_file_data(self, path, rev_hash, chunk_size):
+        '''
+        Yield the contents of a file in pieces of at most chunk_size bytes.
+
+        Files stored by the lfs extension whose blobs are available locally
+        are read from disk incrementally, so the full contents never need to
+        be held in memory.  Revlog and remotefilelog storage can only return
+        the full contents, which are then split up.
+        '''
+        contents = self.blob_cache.get(rev_hash)
+        if contents is None:
+            blob = self._open_local_lfs_blob(path, rev_hash)
+            if blob is not None:
+                for piece in blob.iter_pieces(chunk_size):
+                    yield piece
+                return
+
+            contents = self._get_file_from_repo(path, rev_hash)
+            self.blob_cache.put(rev_hash, contents)
+
+        for offset in range(0, len(contents), chunk_size):
+            yield contents[offset:offset + chunk_size]
+
+    def _open_local_lfs_blob(self, path, rev_hash):
+        '''
+        If the specified file revision is stored externally by the lfs
+        extension and its blob is present in the local blob store, return
+        an LFSBlobReader for it.  Otherwise return None.
+        '''
+        store = getattr(self.repo.svfs, 'lfslocalblobstore', None)
+        pointer_module = getattr(self.lfs, 'pointer', None)
+        extstored_flag = getattr(mercurial.revlog, 'REVIDX_EXTSTORED', 0)
+        if store is None or pointer_module is None or not extstored_flag:
+            return None
+
         try:
-            fctx = self.repo.filectx(path, fileid=rev_hash)
+            fctx = self._get_filectx(path, rev_hash)
+            if not (fctx.rawflags() & extstored_flag):
+                return None
+            oid = pointer_module.deserialize(fctx.rawdata()).oid()
+            if not store.has(oid):
+                return None
+            return LFSBlobReader(oid, store.vfs(oid, 'rb'))
         except Exception:
-            self.repo.invalidate()
-            fctx = self.repo.filectx(path, fileid=rev_hash)
+            # Fall back to reading the contents with fctx.data(), which
+            # handles everything that we do not.
+            logging.debug('unable to read lfs blob for %r directly', path,
+                          exc_info=True)
+            return None
+
+    def _get_filectx(self, path, rev_hash):
+        try:
+            return self.repo.filectx(path, fileid=rev_hash)
+        except Exception:
+            if not self.refresh_repo_if_changed('get_file'):
+                raise
+            return self.repo.filectx(path, fileid=rev_hash)
+
+    def _get_file_from_repo(self, path, rev_hash):
+        with self.remember_failure(('file', path, rev_hash)):
+            return self._get_file_data_with_retry(path, rev_hash)
+
+    def _get_file_data_with_retry(self, path, rev_hash):
+        fctx = self._get_filectx(path, rev_hash)
 
         try:
             return fctx.data()
@@ -576,31 +3165,225 @@ class HgServer(object):
             #
             # Completely re-initialize our repo object and try again, in hopes
             # that this will make the server return data correctly when we
-            # retry.
-            self.repo = self._open_repo()
+            # retry.  This is only done once per change to the local
+            # repository.
+            if not self.reopen_repo_if_changed('get_file'):
+                raise
             fctx = self.repo.filectx(path, fileid=rev_hash)
             return fctx.data()
 
-    def prefetch(self, rev):
-        if not hasattr(self.repo, 'prefetch'):
+    def prefetch_files(self, files):
+        '''
+        Fetch the data for a list of (path, rev_hash) tuples from the
+        remotefilelog server with a single request, if it is not already
+        available locally.
+        '''
+        if not hasattr(self.repo, 'fileservice'):
             # This repo isn't using remotefilelog, so nothing to do.
             return
 
+        fileids = [(path, mercurial.node.hex(rev_hash))
+                   for path, rev_hash in files]
         try:
-            rev_range = mercurial.scmutil.revrange(self.repo, rev)
+            self.repo.fileservice.prefetch(fileids)
         except Exception:
-            self.repo.invalidate()
-            rev_range = mercurial.scmutil.revrange(self.repo, rev)
+            # Prefetching is only an optimization.  If it fails, fall back to
+            # fetching the files one at a time as they are needed.
+            logging.exception('error prefetching %d files', len(fileids))
 
-        self.debug('prefetching')
-        self.repo.prefetch(rev_range)
+    def prefetch(self, rev, path_prefixes=None, progress_callback=None):
+        '''
+        Fetch the contents of all files in the specified revisions from the
+        remotefilelog server, if they are not already available locally.
+
+        If path_prefixes is non-empty, only files under those directories are
+        fetched.  progress_callback(num_done, num_total) is called after each
+        batch of files has been fetched.
+
+        Returns the number of files processed.
+        '''
+        if not hasattr(self.repo, 'fileservice'):
+            # This repo isn't using remotefilelog, so nothing to do.
+            return 0
+
+        try:
+            rev_range = mercurial.scmutil.revrange(self.repo, [rev])
+        except Exception:
+            if not self.refresh_repo_if_changed('prefetch'):
+                raise
+            rev_range = mercurial.scmutil.revrange(self.repo, [rev])
+
+        matcher = self._path_prefix_matcher(path_prefixes)
+        fileids = set()
+        for rev_num in rev_range:
+            mf = self.repo[rev_num].manifest()
+            if matcher is not None:
+                mf = mf.matches(matcher)
+            for path, hashval, _flags in mf.iterentries():
+                fileids.add((path, mercurial.node.hex(hashval)))
+        fileids = sorted(fileids)
+
+        self.debug('prefetching %d files', len(fileids))
+        batch_size = self.ui.configint(CONFIG_SECTION, 'prefetchbatchsize',
+                                       DEFAULT_PREFETCH_BATCH_SIZE)
+        for start in range(0, len(fileids), batch_size):
+            batch = fileids[start:start + batch_size]
+            self.repo.fileservice.prefetch(batch)
+            if progress_callback is not None:
+                progress_callback(start + len(batch), len(fileids))
         self.debug('done prefetching')
+        return len(fileids)
+
+    def _path_prefix_matcher(self, path_prefixes):
+        '''
+        Return a mercurial matcher that matches the files under any of the
+        specified directories, or None if path_prefixes is empty.
+        '''
+        if not path_prefixes:
+            return None
+        patterns = [b'path:' + prefix for prefix in path_prefixes]
+        return mercurial.match.match(self.repo.root, b'', patterns)
 
 
 def always_allow_pending(root):
     return True
 
 
+def remove_socket(path):
+    '''
+    Remove the unix socket at the specified path, if it exists.
+    '''
+    try:
+        os.unlink(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+
+def reap_children(signum, frame):
+    '''
+    SIGCHLD handler for the zygote process, to reap exited children.
+    '''
+    while True:
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            return
+        if pid == 0:
+            return
+
+
+def percentile(sorted_values, pct):
+    '''
+    Return the pct'th percentile of a non-empty sorted list, using the
+    nearest-rank method.
+    '''
+    index = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, index)]
+
+
+def replay_trace(repo_path, config_overrides, num_workers, trace_path):
+    '''
+    Replay the requests from a trace file written with --record-trace
+    against a local HgServer, and print throughput and latency statistics.
+
+    The requests are sent in the order they were originally received, with
+    at most max(1, num_workers) requests outstanding at once.  Transaction
+    IDs are renumbered, and CMD_CANCEL requests are skipped since the
+    requests they referred to are no longer identifiable.
+
+    Requests that received an error response when they were recorded will
+    usually fail again, so errors are counted rather than treated as fatal.
+    '''
+    records = [record for record in read_trace(trace_path)
+               if record.command != CMD_CANCEL]
+    records.sort(key=lambda record: record.received_us)
+
+    request_read_fd, request_write_fd = os.pipe()
+    response_read_fd, response_write_fd = os.pipe()
+    server = HgServer(repo_path, config_overrides, in_fd=request_read_fd,
+                      out_fd=response_write_fd, num_workers=num_workers)
+    server_thread = threading.Thread(target=server.serve,
+                                     name='hg_import_replay_server')
+    server_thread.daemon = True
+    server_thread.start()
+
+    def read_chunk():
+        header = read_exact(response_read_fd, HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise Exception('helper exited before the replay finished')
+        txn_id, command, flags, data_len = struct.unpack(HEADER_FORMAT,
+                                                         header)
+        return txn_id, command, flags, read_exact(response_read_fd, data_len)
+
+    _txn_id, command, flags, data = read_chunk()
+    if command != CMD_STARTED or flags & FLAG_ERROR:
+        raise Exception('helper failed to start: %r' % (data,))
+
+    window = threading.Semaphore(max(1, num_workers))
+    send_times = {}
+    send_lock = threading.Lock()
+
+    def send_requests():
+        for txn_id, record in enumerate(records, 1):
+            window.acquire()
+            header = struct.pack(HEADER_FORMAT, txn_id, record.command,
+                                 record.flags, len(record.body))
+            with send_lock:
+                send_times[txn_id] = time.time()
+            write_all(request_write_fd, [header, record.body])
+        os.close(request_write_fd)
+
+    start = time.time()
+    sender = threading.Thread(target=send_requests,
+                              name='hg_import_replay_sender')
+    sender.daemon = True
+    sender.start()
+
+    latencies = collections.defaultdict(list)
+    num_errors = 0
+    bytes_received = 0
+    for _ in range(len(records)):
+        while True:
+            txn_id, _command, flags, data = read_chunk()
+            bytes_received += HEADER_SIZE + len(data)
+            if flags & FLAG_ERROR or not flags & FLAG_MORE_CHUNKS:
+                break
+        with send_lock:
+            latency = time.time() - send_times.pop(txn_id)
+        window.release()
+        if flags & FLAG_ERROR:
+            num_errors += 1
+        command_name = server._command_name(records[txn_id - 1].command)
+        latencies[command_name].append(latency * 1000)
+    elapsed = time.time() - start
+
+    sender.join()
+    server_thread.join()
+    for fd in (request_read_fd, response_read_fd, response_write_fd):
+        os.close(fd)
+
+    def format_latencies(values):
+        values.sort()
+        return 'p50=%.2fms p90=%.2fms p99=%.2fms max=%.2fms' % (
+            percentile(values, 50), percentile(values, 90),
+            percentile(values, 99), values[-1])
+
+    print('replayed %d requests in %.3f seconds: %.1f requests/s, '
+          '%d bytes received, %d errors' %
+          (len(records), elapsed, len(records) / max(elapsed, 1e-9),
+           bytes_received, num_errors))
+    all_latencies = [value for values in latencies.values()
+                     for value in values]
+    if all_latencies:
+        print('all: %d requests, %s' % (len(all_latencies),
+                                        format_latencies(all_latencies)))
+    for command_name in sorted(latencies):
+        values = latencies[command_name]
+        print('%s: %d requests, %s' % (command_name, len(values),
+                                       format_latencies(values)))
+
+
 ConfigOption = collections.namedtuple('ConfigOption',
                                       ['section', 'name', 'value'])
 
@@ -641,6 +3424,21 @@ def main():
                         metavar='FILENO', type=int,
                         help='Use the specified file descriptor to send '
                         'command output, rather than writing to stdout')
+    parser.add_argument('--workers',
+                        metavar='NUM', type=int, default=0,
+                        help='Process up to NUM requests concurrently, '
+                        'sending responses in completion order.  By default '
+                        'requests are processed one at a time.')
+    parser.add_argument('--zygote',
+                        metavar='SOCKET_PATH',
+                        help='Initialize once, then listen on the specified '
+                        'unix socket and fork a new helper process to serve '
+                        'each connection')
+    parser.add_argument('--record-trace',
+                        metavar='FILE',
+                        help='Append a record of every request processed, '
+                        'with its response size and latency, to FILE.  The '
+                        'trace can be replayed with --replay-trace.')
 
     # Arguments for testing and debugging.
     # These cause the helper to perform a single operation and exit,
@@ -661,6 +3459,21 @@ def main():
                         metavar='PATH:REV',
                         help='Fetch treemanifest data for the specified path '
                         'at the given manifest node')
+    parser.add_argument('--prefetch',
+                        metavar='REVSET',
+                        help='Fetch the contents of all files in the '
+                        'specified revisions from the remotefilelog server')
+    parser.add_argument('--prefetch-path',
+                        metavar='PATH', action='append', default=[],
+                        help='When used with --prefetch, only fetch files '
+                        'under this directory.  May be specified multiple '
+                        'times.')
+    parser.add_argument('--replay-trace',
+                        metavar='FILE',
+                        help='Replay the requests in a trace file recorded '
+                        'with --record-trace against the repository, and '
+                        'report throughput and latency percentiles.  '
+                        'Honors --workers.')
 
     args = parser.parse_args()
     config_overrides = parse_config_options(parser, args.config)
@@ -680,8 +3493,16 @@ def main():
     # we use the correct repository (in case of a shared repository).
     mercurial.txnutil.mayhavepending = always_allow_pending
 
+    if args.replay_trace is not None:
+        replay_trace(args.repo, config_overrides, args.workers,
+                     args.replay_trace)
+        return 0
+
     server = HgServer(args.repo, config_overrides,
-                      in_fd=args.in_fd, out_fd=args.out_fd)
+                      in_fd=args.in_fd, out_fd=args.out_fd,
+                      num_workers=args.workers)
+    if args.record_trace is not None:
+        server.trace_recorder = TraceRecorder(args.record_trace)
 
     if args.get_manifest_node:
         server.initialize()
@@ -726,7 +3547,21 @@ def main():
         server.fetch_tree(path, manifest_node)
         return 0
 
+    if args.prefetch is not None:
+        server.initialize()
+
+        def log_progress(num_done, num_total):
+            logging.info('prefetched %d of %d files', num_done, num_total)
+
+        path_prefixes = [path.encode(sys.getfilesystemencoding())
+                         for path in args.prefetch_path]
+        server.prefetch(args.prefetch, path_prefixes,
+                        progress_callback=log_progress)
+        return 0
+
     try:
+        if args.zygote is not None:
+            return server.serve_zygote(args.zygote)
         return server.serve()
     except KeyboardInterrupt:
         logging.debug('hg_import_helper received interrupt; shutting down')
@@ -7,13 +7,25 @@
  *  of patent rights can be found in the PATENTS file in the same directory.
  *
  */
+#include <boost/filesystem.hpp>
+#include <folly/Conv.h>
+#include <folly/FileUtil.h>
+#include <folly/ScopeGuard.h>
+#include <folly/Subprocess.h>
 #include <folly/experimental/TestUtil.h>
 #include <folly/experimental/logging/Init.h>
 #include <folly/experimental/logging/xlog.h>
 #include <folly/init/Init.h>
+#include <folly/io/Cursor.h>
+#include <folly/io/IOBuf.h>
+#include <folly/lang/Bits.h>
 #include <folly/test/TestUtils.h>
 #include <gmock/gmock.h>
 #include <gtest/gtest.h>
+#include <unistd.h>
+#include <algorithm>
+#include <array>
+#include <map>
 
 #include "eden/fs/model/Blob.h"
 #include "eden/fs/model/Hash.h"
@@ -29,10 +41,15 @@
 DEFINE_string(logging, "", "folly::logging configuration");
 
 using namespace facebook::eden;
+using folly::ByteRange;
+using folly::Endian;
 using folly::StringPiece;
+using folly::Subprocess;
 using folly::test::TemporaryDirectory;
+using std::string;
 using std::vector;
 using testing::ElementsAre;
+using testing::HasSubstr;
 
 namespace {
 vector<PathComponent> getTreeEntryNames(const Tree* tree) {
@@ -42,6 +59,318 @@ vector<PathComponent> getTreeEntryNames(const Tree* tree) {
   }
   return results;
 }
+
+/*
+ * Protocol values used by the tests that talk to hg_import_helper.py
+ * directly.  These must match the values in hg_import_helper.py.
+ */
+constexpr uint32_t CMD_STARTED = 0;
+constexpr uint32_t CMD_MANIFEST = 2;
+constexpr uint32_t CMD_MANIFEST_NODE_FOR_COMMIT = 4;
+constexpr uint32_t CMD_CAT_FILE_BATCH = 6;
+constexpr uint32_t CMD_MANIFEST_DIFF = 8;
+constexpr uint32_t CMD_PREFETCH = 10;
+constexpr uint32_t CMD_FILE_METADATA = 12;
+constexpr uint32_t CMD_MANIFEST_ENTRIES = 14;
+constexpr uint32_t CMD_CAT_FILE_DELTA = 16;
+constexpr uint32_t CMD_FETCH_TREES = 17;
+constexpr uint32_t CMD_GET_TREE = 18;
+constexpr uint32_t FLAG_ERROR = 0x01;
+constexpr uint32_t FLAG_MORE_CHUNKS = 0x02;
+constexpr uint32_t FLAG_COMPACT_MANIFEST = 0x10;
+constexpr uint32_t START_FLAGS_CONCURRENT_RESPONSES = 0x02;
+constexpr uint32_t START_FLAGS_COMPACT_MANIFEST = 0x08;
+
+struct ManifestEntry {
+  Hash hash;
+  string flag;
+  string path;
+};
+
+/**
+ * Parse a list of entries in the CMD_MANIFEST response format.
+ */
+vector<ManifestEntry> parseManifestEntries(StringPiece data) {
+  vector<ManifestEntry> entries;
+  while (!data.empty()) {
+    if (data.size() < Hash::RAW_SIZE + 2 || data[Hash::RAW_SIZE] != '\t') {
+      throw std::runtime_error("malformed manifest entry");
+    }
+    ManifestEntry entry;
+    entry.hash = Hash{ByteRange{data.subpiece(0, Hash::RAW_SIZE)}};
+    data.advance(Hash::RAW_SIZE + 1);
+    auto flagEnd = data.find('\t');
+    auto pathEnd = data.find('\0');
+    if (flagEnd == StringPiece::npos || pathEnd == StringPiece::npos) {
+      throw std::runtime_error("malformed manifest entry");
+    }
+    entry.flag = data.subpiece(0, flagEnd).str();
+    entry.path = data.subpiece(flagEnd + 1, pathEnd - flagEnd - 1).str();
+    data.advance(pathEnd + 1);
+    entries.push_back(std::move(entry));
+  }
+  return entries;
+}
+
+uint64_t readVarint(folly::io::Cursor& cursor) {
+  uint64_t value = 0;
+  for (unsigned int shift = 0;; shift += 7) {
+    auto byte = cursor.read<uint8_t>();
+    value |= static_cast<uint64_t>(byte & 0x7f) << shift;
+    if (!(byte & 0x80)) {
+      return value;
+    }
+  }
+}
+
+/**
+ * Parse a list of entries in the compact CMD_MANIFEST encoding used when
+ * FLAG_COMPACT_MANIFEST is set.
+ *
+ * The first entry of every response chunk shares no prefix with the previous
+ * entry, so the joined chunks of a response can be parsed in one go.
+ */
+vector<ManifestEntry> parseCompactManifestEntries(StringPiece data) {
+  vector<ManifestEntry> entries;
+  auto buf = folly::IOBuf::wrapBufferAsValue(ByteRange{data});
+  folly::io::Cursor cursor(&buf);
+  string prevPath;
+  while (!cursor.isAtEnd()) {
+    auto shared = readVarint(cursor);
+    auto suffixLength = readVarint(cursor);
+    if (shared > prevPath.size()) {
+      throw std::runtime_error("malformed compact manifest entry");
+    }
+    ManifestEntry entry;
+    entry.path = prevPath.substr(0, shared);
+    entry.path.append(cursor.readFixedString(suffixLength));
+    auto flag = cursor.read<char>();
+    if (flag != '\0') {
+      entry.flag.push_back(flag);
+    }
+    Hash::Storage hashBytes;
+    cursor.pull(hashBytes.data(), hashBytes.size());
+    entry.hash = Hash{hashBytes};
+    prevPath = entry.path;
+    entries.push_back(std::move(entry));
+  }
+  return entries;
+}
+
+Hash findFileHash(const vector<ManifestEntry>& entries, StringPiece path) {
+  for (const auto& entry : entries) {
+    if (entry.path == path) {
+      return entry.hash;
+    }
+  }
+  throw std::runtime_error(folly::to<string>("no manifest entry for ", path));
+}
+
+vector<string> listDirectory(AbsolutePathPiece path) {
+  vector<string> names;
+  boost::filesystem::directory_iterator end;
+  for (boost::filesystem::directory_iterator it(path.value().str()); it != end;
+       ++it) {
+    names.push_back(it->path().filename().string());
+  }
+  std::sort(names.begin(), names.end());
+  return names;
+}
+
+/**
+ * Return the body of a request for a file revision, in the <rev_hash><path>
+ * format used by CMD_CAT_FILE and similar requests.
+ */
+string fileRequestBody(const Hash& revHash, StringPiece path) {
+  return folly::to<string>(StringPiece{revHash.getBytes()}, path);
+}
+
+/**
+ * Apply a delta in mercurial's binary patch format, as sent in
+ * CMD_CAT_FILE_DELTA responses.
+ *
+ * The delta is a list of hunks, each of the form <start><end><length><data>,
+ * which replace the bytes [start, end) of the base text with <data>.
+ */
+string applyMdiff(StringPiece base, StringPiece delta) {
+  auto buf = folly::IOBuf::wrapBufferAsValue(ByteRange{delta});
+  folly::io::Cursor cursor(&buf);
+  string result;
+  size_t basePos = 0;
+  while (!cursor.isAtEnd()) {
+    auto start = cursor.readBE<uint32_t>();
+    auto end = cursor.readBE<uint32_t>();
+    auto length = cursor.readBE<uint32_t>();
+    if (start < basePos || end < start || end > base.size()) {
+      throw std::runtime_error("malformed mdiff hunk");
+    }
+    result.append(base.subpiece(basePos, start - basePos).str());
+    result.append(cursor.readFixedString(length));
+    basePos = end;
+  }
+  result.append(base.subpiece(basePos).str());
+  return result;
+}
+
+void appendUint32(string& out, uint32_t value) {
+  auto bigEndian = Endian::big(value);
+  out.append(reinterpret_cast<const char*>(&bigEndian), sizeof(bigEndian));
+}
+
+/**
+ * Encode a list of (hash, path) pairs in the format used by
+ * CMD_CAT_FILE_BATCH and CMD_FETCH_TREES requests.
+ */
+string encodeFileList(const vector<std::pair<Hash, string>>& files) {
+  string body;
+  appendUint32(body, files.size());
+  for (const auto& file : files) {
+    auto hashBytes = file.first.getBytes();
+    body.append(
+        reinterpret_cast<const char*>(hashBytes.data()), hashBytes.size());
+    appendUint32(body, file.second.size());
+    body.append(file.second);
+  }
+  return body;
+}
+
+struct HelperChunk {
+  uint32_t requestID;
+  uint32_t command;
+  uint32_t flags;
+  string data;
+};
+
+/**
+ * Runs hg_import_helper.py and talks to it directly, so that tests can send
+ * requests that HgImporter itself does not use.
+ */
+class ImportHelper {
+ public:
+  explicit ImportHelper(
+      AbsolutePathPiece repoPath,
+      const vector<string>& extraArgs = {}) {
+    vector<string> cmd = {getImportHelperPath().value().str(),
+                          repoPath.value().str()};
+    cmd.insert(cmd.end(), extraArgs.begin(), extraArgs.end());
+    Subprocess::Options opts;
+    opts.stdinFd(Subprocess::PIPE).stdoutFd(Subprocess::PIPE);
+    process_ = Subprocess{cmd, opts};
+    SCOPE_FAIL {
+      process_.closeParentFd(STDIN_FILENO);
+      process_.wait();
+    };
+
+    auto started = readChunk();
+    if (started.command != CMD_STARTED) {
+      throw std::runtime_error(
+          "unexpected start message from hg_import_helper script");
+    }
+    auto startedBuf =
+        folly::IOBuf::wrapBufferAsValue(ByteRange{StringPiece{started.data}});
+    folly::io::Cursor cursor(&startedBuf);
+    cursor.skip(sizeof(uint32_t)); // protocol version
+    startFlags_ = cursor.readBE<uint32_t>();
+  }
+
+  ~ImportHelper() {
+    process_.closeParentFd(STDIN_FILENO);
+    process_.wait();
+  }
+
+  uint32_t getStartFlags() const {
+    return startFlags_;
+  }
+
+  /**
+   * Send a request, and return its transaction ID.
+   */
+  uint32_t send(uint32_t command, StringPiece body, uint32_t flags = 0) {
+    auto requestID = nextRequestID_++;
+    uint32_t header[4] = {
+        Endian::big(requestID),
+        Endian::big(command),
+        Endian::big(flags),
+        Endian::big<uint32_t>(body.size()),
+    };
+    std::array<struct iovec, 2> iov;
+    iov[0].iov_base = header;
+    iov[0].iov_len = sizeof(header);
+    iov[1].iov_base = const_cast<char*>(body.data());
+    iov[1].iov_len = body.size();
+    folly::checkUnixError(
+        folly::writevFull(process_.stdinFd(), iov.data(), iov.size()),
+        "error sending request to hg_import_helper");
+    return requestID;
+  }
+
+  HelperChunk readChunk() {
+    uint32_t header[4];
+    readData(header, sizeof(header));
+
+    HelperChunk chunk;
+    chunk.requestID = Endian::big(header[0]);
+    chunk.command = Endian::big(header[1]);
+    chunk.flags = Endian::big(header[2]);
+    chunk.data.resize(Endian::big(header[3]));
+    if (!chunk.data.empty()) {
+      readData(&chunk.data[0], chunk.data.size());
+    }
+    return chunk;
+  }
+
+  /**
+   * Send a request and wait for its response.
+   *
+   * Returns the response body, joined together from all of its chunks.
+   * Throws an HgImportPyError if the helper sent an error response.
+   *
+   * This may only be used if the helper was started without --workers,
+   * since it expects the response chunks to arrive in order.
+   */
+  string request(uint32_t command, StringPiece body, uint32_t flags = 0) {
+    auto requestID = send(command, body, flags);
+    string result;
+    while (true) {
+      auto chunk = readChunk();
+      if (chunk.requestID != requestID) {
+        throw std::runtime_error(folly::to<string>(
+            "received response for transaction ",
+            chunk.requestID,
+            " while waiting for ",
+            requestID));
+      }
+      if (chunk.flags & FLAG_ERROR) {
+        throwError(chunk.data);
+      }
+      result.append(chunk.data);
+      if (!(chunk.flags & FLAG_MORE_CHUNKS)) {
+        return result;
+      }
+    }
+  }
+
+ private:
+  void readData(void* buf, size_t length) {
+    auto bytesRead = folly::readFull(process_.stdoutFd(), buf, length);
+    folly::checkUnixError(bytesRead, "error reading from hg_import_helper");
+    if (static_cast<size_t>(bytesRead) != length) {
+      throw std::runtime_error("unexpected EOF from hg_import_helper");
+    }
+  }
+
+  [[noreturn]] static void throwError(StringPiece data) {
+    auto buf = folly::IOBuf::wrapBufferAsValue(ByteRange{data});
+    folly::io::Cursor cursor(&buf);
+    auto errorType = cursor.readFixedString(cursor.readBE<uint32_t>());
+    auto message = cursor.readFixedString(cursor.readBE<uint32_t>());
+    throw HgImportPyError(errorType, message);
+  }
+
+  Subprocess process_;
+  uint32_t startFlags_{0};
+  uint32_t nextRequestID_{1};
+};
 } // namespace
 
 class HgImportTest : public ::testing::Test {
@@ -52,6 +381,7 @@ class HgImportTest : public ::testing::Test {
   }
 
  protected:
+  void enableTreeManifest();
   void importTest(bool treemanifest);
 
   TemporaryDirectory testDir_{"eden_test"};
@@ -191,7 +521,7 @@ TEST_F(HgImportTest, importFlatManifest) {
   importTest(false);
 }
 
-TEST_F(HgImportTest, importTreeManifest) {
+void HgImportTest::enableTreeManifest() {
   repo_.appendToHgrc({"[extensions]",
                       "fastmanifest=",
                       "treemanifest=",
@@ -207,10 +537,598 @@ TEST_F(HgImportTest, importTreeManifest) {
                       "[treemanifest]",
                       "usecunionstore=True",
                       "autocreatetrees=True"});
+}
 
+TEST_F(HgImportTest, importTreeManifest) {
+  enableTreeManifest();
   importTest(true);
 }
 
+TEST_F(HgImportTest, concurrentResponses) {
+  repo_.writeFile("foo.txt", "first version\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("First commit");
+  repo_.writeFile("foo.txt", "second version\n");
+  auto commit2 = repo_.commit("Second commit");
+
+  // Resolve the expected manifest nodes using the regular HgImporter, which
+  // sends one request at a time.
+  HgImporter importer(repo_.path(), &localStore_);
+  auto manifest1 = importer.resolveManifestNode(commit1.toString());
+  auto manifest2 = importer.resolveManifestNode(commit2.toString());
+  ASSERT_NE(manifest1, manifest2);
+
+  // Start a helper with several worker threads.  It sends each response as
+  // soon as it is ready, so responses may arrive in any order and must be
+  // matched with their requests by transaction ID.
+  ImportHelper helper(repo_.path(), {"--workers", "2"});
+  EXPECT_TRUE(helper.getStartFlags() & START_FLAGS_CONCURRENT_RESPONSES);
+
+  // Send all of the requests before reading any responses.
+  std::map<uint32_t, string> requests;
+  for (const auto& rev : {commit1.toString(),
+                          string{"no-such-revision"},
+                          commit2.toString(),
+                          commit1.toString()}) {
+    requests.emplace(helper.send(CMD_MANIFEST_NODE_FOR_COMMIT, rev), rev);
+  }
+
+  std::map<uint32_t, HelperChunk> responses;
+  for (size_t n = 0; n < requests.size(); ++n) {
+    auto chunk = helper.readChunk();
+    ASSERT_TRUE(requests.count(chunk.requestID))
+        << "unexpected transaction ID " << chunk.requestID;
+    ASSERT_FALSE(responses.count(chunk.requestID))
+        << "duplicate response for transaction " << chunk.requestID;
+    responses.emplace(chunk.requestID, std::move(chunk));
+  }
+
+  for (const auto& request : requests) {
+    const auto& chunk = responses.at(request.first);
+    if (request.second == "no-such-revision") {
+      EXPECT_TRUE(chunk.flags & FLAG_ERROR);
+      EXPECT_THAT(chunk.data, HasSubstr("unknown revision"));
+      continue;
+    }
+    EXPECT_FALSE(chunk.flags & FLAG_ERROR);
+    auto expected =
+        request.second == commit2.toString() ? manifest2 : manifest1;
+    EXPECT_EQ(expected, Hash{ByteRange{StringPiece{chunk.data}}});
+  }
+}
+
+TEST_F(HgImportTest, catFileBatch) {
+  repo_.mkdir("dir");
+  StringPiece aData = "contents of a\n";
+  repo_.writeFile("a.txt", aData);
+  StringPiece bData = "contents of b\n";
+  repo_.writeFile("dir/b.txt", bData);
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  auto entries =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString()));
+  auto aHash = findFileHash(entries, "a.txt");
+  auto bHash = findFileHash(entries, "dir/b.txt");
+
+  // The contents are returned in the order that the files were requested.
+  auto response = helper.request(
+      CMD_CAT_FILE_BATCH,
+      encodeFileList(
+          {{bHash, "dir/b.txt"}, {aHash, "a.txt"}, {bHash, "dir/b.txt"}}));
+  auto buf = folly::IOBuf::wrapBufferAsValue(ByteRange{StringPiece{response}});
+  folly::io::Cursor cursor(&buf);
+  vector<string> contents;
+  while (!cursor.isAtEnd()) {
+    contents.push_back(cursor.readFixedString(cursor.readBE<uint32_t>()));
+  }
+  EXPECT_THAT(contents, ElementsAre(bData, aData, bData));
+
+  EXPECT_EQ("", helper.request(CMD_CAT_FILE_BATCH, encodeFileList({})));
+  EXPECT_THROW(
+      helper.request(
+          CMD_CAT_FILE_BATCH,
+          encodeFileList({{aHash, "a.txt"}, {makeTestHash("123"), "a.txt"}})),
+      HgImportPyError);
+  auto truncated = encodeFileList({{aHash, "a.txt"}}).substr(0, 10);
+  EXPECT_THROW_RE(
+      helper.request(CMD_CAT_FILE_BATCH, truncated),
+      HgImportPyError,
+      "file list truncated");
+}
+
+TEST_F(HgImportTest, manifestDiff) {
+  repo_.mkdir("dir");
+  repo_.writeFile("a.txt", "first version of a\n");
+  repo_.writeFile("dir/b.txt", "contents of b\n");
+  repo_.writeFile("c.txt", "contents of c\n");
+  repo_.writeFile("unchanged.txt", "unchanged\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("First commit");
+
+  repo_.writeFile("a.txt", "second version of a\n");
+  repo_.writeFile("dir/b.txt", "contents of b\n", 0755);
+  repo_.hg("rm", "c.txt");
+  repo_.writeFile("d.txt", "contents of d\n");
+  repo_.hg("add", "d.txt");
+  auto commit2 = repo_.commit("Second commit");
+
+  ImportHelper helper(repo_.path());
+  auto entries2 =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit2.toString()));
+
+  auto diff = helper.request(
+      CMD_MANIFEST_DIFF,
+      folly::to<string>(commit1.toString(), '\0', commit2.toString()));
+  // Each entry is a status character followed by an entry in the CMD_MANIFEST
+  // format.  Split them apart.
+  vector<char> statuses;
+  string entryData;
+  StringPiece remaining{diff};
+  while (!remaining.empty()) {
+    statuses.push_back(remaining[0]);
+    auto end = remaining.find('\0', 1 + Hash::RAW_SIZE);
+    ASSERT_NE(StringPiece::npos, end);
+    entryData.append(remaining.subpiece(1, end).str());
+    remaining.advance(end + 1);
+  }
+  auto entries = parseManifestEntries(entryData);
+
+  EXPECT_THAT(statuses, ElementsAre('M', 'R', 'A', 'M'));
+  ASSERT_EQ(4u, entries.size());
+  EXPECT_EQ("a.txt", entries[0].path);
+  EXPECT_EQ(findFileHash(entries2, "a.txt"), entries[0].hash);
+  EXPECT_EQ("", entries[0].flag);
+  EXPECT_EQ("c.txt", entries[1].path);
+  EXPECT_EQ(kZeroHash, entries[1].hash);
+  EXPECT_EQ("", entries[1].flag);
+  EXPECT_EQ("d.txt", entries[2].path);
+  EXPECT_EQ(findFileHash(entries2, "d.txt"), entries[2].hash);
+  EXPECT_EQ("dir/b.txt", entries[3].path);
+  EXPECT_EQ(findFileHash(entries2, "dir/b.txt"), entries[3].hash);
+  EXPECT_EQ("x", entries[3].flag);
+
+  // Diffing a revision against itself returns no entries.
+  EXPECT_EQ(
+      "",
+      helper.request(
+          CMD_MANIFEST_DIFF,
+          folly::to<string>(commit2.toString(), '\0', commit2.toString())));
+  EXPECT_THROW_RE(
+      helper.request(CMD_MANIFEST_DIFF, commit1.toString()),
+      HgImportPyError,
+      "missing a base revision");
+}
+
+TEST_F(HgImportTest, manifestCache) {
+  repo_.writeFile("a.txt", "contents of a\n");
+  repo_.writeFile("b.txt", "contents of b\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  auto cacheDir = testPath_ + PathComponentPiece{"manifest_cache"};
+  vector<string> args = {
+      "--config",
+      folly::to<string>("edenfs.manifestcachedir=", cacheDir.value())};
+  string manifestData;
+  string cacheFileName;
+  {
+    ImportHelper helper(repo_.path(), args);
+    auto manifestNode = Hash{ByteRange{StringPiece{helper.request(
+        CMD_MANIFEST_NODE_FOR_COMMIT, commit1.toString())}}};
+    cacheFileName = manifestNode.toString();
+
+    manifestData = helper.request(CMD_MANIFEST, commit1.toString());
+    EXPECT_THAT(listDirectory(cacheDir), ElementsAre(cacheFileName));
+    EXPECT_EQ(manifestData, helper.request(CMD_MANIFEST, commit1.toString()));
+
+    // A failed lookup must not leave a temporary file behind.
+    EXPECT_THROW(
+        helper.request(CMD_MANIFEST, "no-such-revision"), HgImportPyError);
+    EXPECT_THAT(listDirectory(cacheDir), ElementsAre(cacheFileName));
+  }
+
+  // The cache file holds the response chunks, each preceded by its length.
+  string cacheContents;
+  ASSERT_TRUE(folly::readFile(
+      (cacheDir + PathComponentPiece{cacheFileName}).value().c_str(),
+      cacheContents));
+  string expectedContents;
+  appendUint32(expectedContents, manifestData.size());
+  expectedContents.append(manifestData);
+  EXPECT_EQ(expectedContents, cacheContents);
+
+  // A new helper process serves the manifest straight from the cache file.
+  // Replace its contents to check that the repository is not consulted.
+  auto fakeEntry = folly::to<string>(
+      string(Hash::RAW_SIZE, '\x01'), "\t\tfake.txt", '\0');
+  string fakeContents;
+  appendUint32(fakeContents, fakeEntry.size());
+  fakeContents.append(fakeEntry);
+  ASSERT_TRUE(folly::writeFile(
+      fakeContents,
+      (cacheDir + PathComponentPiece{cacheFileName}).value().c_str()));
+  ImportHelper helper(repo_.path(), args);
+  EXPECT_EQ(fakeEntry, helper.request(CMD_MANIFEST, commit1.toString()));
+}
+
+TEST_F(HgImportTest, prefetchWithoutRemotefilelog) {
+  repo_.mkdir("dir");
+  repo_.writeFile("dir/a.txt", "contents of a\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  // This repository does not use remotefilelog, so all of its files are
+  // already local.  The helper reports that it had no files to fetch, with
+  // a single progress chunk of <num_done=0><num_total=0>.
+  ImportHelper helper(repo_.path());
+  EXPECT_EQ(string(16, '\0'), helper.request(CMD_PREFETCH, commit1.toString()));
+  EXPECT_EQ(
+      string(16, '\0'),
+      helper.request(
+          CMD_PREFETCH, folly::to<string>(commit1.toString(), '\0', "dir")));
+}
+
+TEST_F(HgImportTest, fileMetadata) {
+  StringPiece aData = "contents of a\n";
+  repo_.writeFile("a.txt", aData);
+  repo_.writeFile("empty.txt", "");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  auto entries =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString()));
+
+  auto getMetadata = [&](StringPiece path) {
+    auto response = helper.request(
+        CMD_FILE_METADATA,
+        fileRequestBody(findFileHash(entries, path), path));
+    EXPECT_EQ(sizeof(uint64_t) + Hash::RAW_SIZE, response.size());
+    auto buf =
+        folly::IOBuf::wrapBufferAsValue(ByteRange{StringPiece{response}});
+    folly::io::Cursor cursor(&buf);
+    auto size = cursor.readBE<uint64_t>();
+    Hash::Storage sha1;
+    cursor.pull(sha1.data(), sha1.size());
+    return std::make_pair(size, Hash{sha1});
+  };
+
+  auto expected = std::make_pair(
+      static_cast<uint64_t>(aData.size()), Hash::sha1(ByteRange{aData}));
+  EXPECT_EQ(expected, getMetadata("a.txt"));
+  // The second request is answered from the metadata cache.
+  EXPECT_EQ(expected, getMetadata("a.txt"));
+  EXPECT_EQ(
+      std::make_pair(uint64_t{0}, Hash::sha1(ByteRange{})),
+      getMetadata("empty.txt"));
+
+  EXPECT_THROW(
+      helper.request(
+          CMD_FILE_METADATA, fileRequestBody(makeTestHash("123"), "a.txt")),
+      HgImportPyError);
+}
+
+TEST_F(HgImportTest, resolveBookmarkCreatedAfterStart) {
+  repo_.writeFile("foo.txt", "first version\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("First commit");
+  repo_.writeFile("foo.txt", "second version\n");
+  auto commit2 = repo_.commit("Second commit");
+
+  ImportHelper helper(repo_.path());
+  auto resolve = [&](StringPiece rev) {
+    return Hash{ByteRange{
+        StringPiece{helper.request(CMD_MANIFEST_NODE_FOR_COMMIT, rev)}}};
+  };
+  auto manifest1 = resolve(commit1.toString());
+  auto manifest2 = resolve(commit2.toString());
+
+  // Creating or moving a bookmark does not change the changelog, but the
+  // helper must still notice it, even after a failed lookup of the same name.
+  EXPECT_THROW(resolve("mybook"), HgImportPyError);
+  repo_.hg("bookmark", "-r", commit1.toString(), "mybook");
+  EXPECT_EQ(manifest1, resolve("mybook"));
+  repo_.hg("bookmark", "-f", "-r", commit2.toString(), "mybook");
+  EXPECT_EQ(manifest2, resolve("mybook"));
+}
+
+TEST_F(HgImportTest, resolveWorkingCopyParentAfterUpdate) {
+  repo_.writeFile("foo.txt", "first version\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("First commit");
+  repo_.writeFile("foo.txt", "second version\n");
+  auto commit2 = repo_.commit("Second commit");
+
+  ImportHelper helper(repo_.path());
+  auto resolve = [&](StringPiece rev) {
+    return Hash{ByteRange{
+        StringPiece{helper.request(CMD_MANIFEST_NODE_FOR_COMMIT, rev)}}};
+  };
+  auto manifest1 = resolve(commit1.toString());
+  auto manifest2 = resolve(commit2.toString());
+
+  // "." is cached until the dirstate changes, and must then be resolved
+  // from the new dirstate rather than the one read when the helper started.
+  EXPECT_EQ(manifest2, resolve("."));
+  EXPECT_EQ(manifest2, resolve("."));
+  repo_.hg("update", commit1.toString());
+  EXPECT_EQ(manifest1, resolve("."));
+  repo_.hg("update", commit2.toString());
+  EXPECT_EQ(manifest2, resolve("."));
+}
+
+TEST_F(HgImportTest, manifestEntries) {
+  repo_.mkdir("dir");
+  repo_.writeFile("a.txt", "contents of a\n");
+  repo_.writeFile("dir/b.sh", "#!/bin/sh\n", 0755);
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  auto allEntries =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString()));
+
+  // The entries are returned in the order the paths were requested, and
+  // paths that are not files in the revision are left out.
+  auto entries = parseManifestEntries(helper.request(
+      CMD_MANIFEST_ENTRIES,
+      folly::to<string>(
+          commit1.toString(),
+          '\0',
+          "dir/b.sh",
+          '\0',
+          "missing.txt",
+          '\0',
+          "dir",
+          '\0',
+          "a.txt")));
+  ASSERT_EQ(2u, entries.size());
+  EXPECT_EQ("dir/b.sh", entries[0].path);
+  EXPECT_EQ(findFileHash(allEntries, "dir/b.sh"), entries[0].hash);
+  EXPECT_EQ("x", entries[0].flag);
+  EXPECT_EQ("a.txt", entries[1].path);
+  EXPECT_EQ(findFileHash(allEntries, "a.txt"), entries[1].hash);
+  EXPECT_EQ("", entries[1].flag);
+
+  EXPECT_EQ("", helper.request(CMD_MANIFEST_ENTRIES, commit1.toString()));
+  EXPECT_THROW(
+      helper.request(
+          CMD_MANIFEST_ENTRIES,
+          folly::to<string>("no-such-revision", '\0', "a.txt")),
+      HgImportPyError);
+}
+
+TEST_F(HgImportTest, manifestPathPrefixes) {
+  repo_.mkdir("dir1");
+  repo_.mkdir("dir1/sub");
+  repo_.mkdir("dir10");
+  repo_.mkdir("dir2");
+  repo_.writeFile("dir1/a.txt", "a\n");
+  repo_.writeFile("dir1/sub/b.txt", "b\n");
+  repo_.writeFile("dir10/c.txt", "c\n");
+  repo_.writeFile("dir2/d.txt", "d\n");
+  repo_.writeFile("top.txt", "top\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  auto allEntries =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString()));
+  ASSERT_EQ(5u, allEntries.size());
+
+  auto getPaths = [&](const vector<string>& prefixes) {
+    auto body = commit1.toString();
+    for (const auto& prefix : prefixes) {
+      body.push_back('\0');
+      body.append(prefix);
+    }
+    vector<string> paths;
+    for (const auto& entry :
+         parseManifestEntries(helper.request(CMD_MANIFEST, body))) {
+      EXPECT_EQ(findFileHash(allEntries, entry.path), entry.hash);
+      paths.push_back(entry.path);
+    }
+    return paths;
+  };
+
+  // A prefix matches whole directory names only, so "dir1" does not include
+  // "dir10".
+  EXPECT_THAT(
+      getPaths({"dir1", "dir2"}),
+      ElementsAre("dir1/a.txt", "dir1/sub/b.txt", "dir2/d.txt"));
+  EXPECT_THAT(getPaths({"dir1/sub"}), ElementsAre("dir1/sub/b.txt"));
+  EXPECT_THAT(getPaths({"missing"}), ElementsAre());
+}
+
+TEST_F(HgImportTest, compactManifest) {
+  repo_.mkdir("src");
+  repo_.mkdir("src/lib");
+  repo_.writeFile("README", "readme\n");
+  repo_.writeFile("src/lib/a.py", "a\n");
+  repo_.writeFile("src/lib/ab.py", "ab\n");
+  repo_.writeFile("src/run.sh", "#!/bin/sh\n", 0755);
+  repo_.symlink("lib/a.py", RelativePathPiece{"src/link"});
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  EXPECT_TRUE(helper.getStartFlags() & START_FLAGS_COMPACT_MANIFEST);
+
+  auto plainEntries =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString()));
+  auto compactData = helper.request(
+      CMD_MANIFEST, commit1.toString(), FLAG_COMPACT_MANIFEST);
+  auto compactEntries = parseCompactManifestEntries(compactData);
+
+  // The compact encoding holds the same entries in the same order, without
+  // repeating the directory names that consecutive paths share.
+  ASSERT_EQ(5u, plainEntries.size());
+  ASSERT_EQ(plainEntries.size(), compactEntries.size());
+  size_t pathBytes = 0;
+  for (size_t n = 0; n < plainEntries.size(); ++n) {
+    EXPECT_EQ(plainEntries[n].path, compactEntries[n].path);
+    EXPECT_EQ(plainEntries[n].hash, compactEntries[n].hash);
+    EXPECT_EQ(plainEntries[n].flag, compactEntries[n].flag);
+    pathBytes += plainEntries[n].path.size();
+  }
+  EXPECT_LT(
+      compactData.size(),
+      pathBytes + plainEntries.size() * (Hash::RAW_SIZE + 2));
+  EXPECT_EQ("src/link", compactEntries[3].path);
+  EXPECT_EQ("l", compactEntries[3].flag);
+  EXPECT_EQ("src/run.sh", compactEntries[4].path);
+  EXPECT_EQ("x", compactEntries[4].flag);
+
+  // Path prefixes may be combined with the compact encoding.
+  auto subdirEntries = parseCompactManifestEntries(helper.request(
+      CMD_MANIFEST,
+      folly::to<string>(commit1.toString(), '\0', "src/lib"),
+      FLAG_COMPACT_MANIFEST));
+  ASSERT_EQ(2u, subdirEntries.size());
+  EXPECT_EQ("src/lib/a.py", subdirEntries[0].path);
+  EXPECT_EQ("src/lib/ab.py", subdirEntries[1].path);
+}
+
+TEST_F(HgImportTest, catFileDelta) {
+  string version1;
+  for (int n = 0; n < 1000; ++n) {
+    version1 += folly::to<string>("line ", n, "\n");
+  }
+  auto version2 = version1;
+  version2.replace(version2.find("line 500\n"), 9, "changed\n");
+  repo_.writeFile("gen.txt", version1);
+  repo_.hg("add");
+  auto commit1 = repo_.commit("First commit");
+  repo_.writeFile("gen.txt", version2);
+  auto commit2 = repo_.commit("Second commit");
+
+  ImportHelper helper(repo_.path());
+  auto hash1 = findFileHash(
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString())),
+      "gen.txt");
+  auto hash2 = findFileHash(
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit2.toString())),
+      "gen.txt");
+  auto deltaRequest = [&](const Hash& revHash, const Hash& baseHash) {
+    return helper.request(
+        CMD_CAT_FILE_DELTA,
+        folly::to<string>(
+            StringPiece{revHash.getBytes()},
+            StringPiece{baseHash.getBytes()},
+            "gen.txt"));
+  };
+
+  // A small change is sent as a delta against the base revision.
+  auto response = deltaRequest(hash2, hash1);
+  ASSERT_FALSE(response.empty());
+  EXPECT_EQ('\x01', response[0]);
+  EXPECT_LT(response.size(), version2.size());
+  EXPECT_EQ(version2, applyMdiff(version1, StringPiece{response}.subpiece(1)));
+
+  // The full contents are sent if the base revision is unknown.
+  EXPECT_EQ(
+      folly::to<string>('\0', version2),
+      deltaRequest(hash2, makeTestHash("123")));
+
+  EXPECT_THROW(deltaRequest(makeTestHash("123"), hash1), HgImportPyError);
+  EXPECT_THROW_RE(
+      helper.request(CMD_CAT_FILE_DELTA, "short"),
+      HgImportPyError,
+      "request data too short");
+}
+
+TEST_F(HgImportTest, fetchTreesWithoutTreemanifest) {
+  repo_.mkdir("dir");
+  repo_.writeFile("dir/a.txt", "contents of a\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  // Actually fetching trees requires a treemanifest server, so this only
+  // checks the request handling.  An empty list needs no server at all.
+  ImportHelper helper(repo_.path());
+  EXPECT_EQ("", helper.request(CMD_FETCH_TREES, encodeFileList({})));
+
+  auto manifestNode = Hash{ByteRange{StringPiece{helper.request(
+      CMD_MANIFEST_NODE_FOR_COMMIT, commit1.toString())}}};
+  EXPECT_THROW_RE(
+      helper.request(
+          CMD_FETCH_TREES,
+          encodeFileList({{manifestNode, ""}, {makeTestHash("1"), "dir"}})),
+      HgImportPyError,
+      "treemanifest not enabled in this repository");
+  EXPECT_THROW_RE(
+      helper.request(
+          CMD_FETCH_TREES, encodeFileList({{manifestNode, ""}}).substr(0, 10)),
+      HgImportPyError,
+      "file list truncated");
+}
+
+TEST_F(HgImportTest, getTree) {
+  enableTreeManifest();
+  repo_.mkdir("dir");
+  repo_.mkdir("dir/sub");
+  repo_.writeFile("dir/a.txt", "contents of a\n");
+  repo_.writeFile("dir/sub/b.txt", "contents of b\n");
+  repo_.writeFile("top.sh", "#!/bin/sh\n", 0755);
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  auto fileEntries =
+      parseManifestEntries(helper.request(CMD_MANIFEST, commit1.toString()));
+  auto rootNode = Hash{ByteRange{StringPiece{helper.request(
+      CMD_MANIFEST_NODE_FOR_COMMIT, commit1.toString())}}};
+  auto getTree = [&](const Hash& manifestNode, StringPiece path) {
+    return parseManifestEntries(helper.request(
+        CMD_GET_TREE,
+        folly::to<string>(StringPiece{manifestNode.getBytes()}, path)));
+  };
+
+  // Entries are named relative to their directory, and subdirectories are
+  // listed with the 't' flag and their own manifest node.
+  auto root = getTree(rootNode, "");
+  ASSERT_EQ(2u, root.size());
+  EXPECT_EQ("dir", root[0].path);
+  EXPECT_EQ("t", root[0].flag);
+  EXPECT_EQ("top.sh", root[1].path);
+  EXPECT_EQ("x", root[1].flag);
+  EXPECT_EQ(findFileHash(fileEntries, "top.sh"), root[1].hash);
+
+  auto dir = getTree(root[0].hash, "dir");
+  ASSERT_EQ(2u, dir.size());
+  EXPECT_EQ("a.txt", dir[0].path);
+  EXPECT_EQ("", dir[0].flag);
+  EXPECT_EQ(findFileHash(fileEntries, "dir/a.txt"), dir[0].hash);
+  EXPECT_EQ("sub", dir[1].path);
+  EXPECT_EQ("t", dir[1].flag);
+
+  auto sub = getTree(dir[1].hash, "dir/sub");
+  ASSERT_EQ(1u, sub.size());
+  EXPECT_EQ("b.txt", sub[0].path);
+  EXPECT_EQ(findFileHash(fileEntries, "dir/sub/b.txt"), sub[0].hash);
+
+  EXPECT_THROW_RE(
+      helper.request(CMD_GET_TREE, "short"),
+      HgImportPyError,
+      "request data too short");
+}
+
+TEST_F(HgImportTest, getTreeWithoutTreemanifest) {
+  repo_.writeFile("a.txt", "contents of a\n");
+  repo_.hg("add");
+  auto commit1 = repo_.commit("Initial commit");
+
+  ImportHelper helper(repo_.path());
+  auto rootNode =
+      helper.request(CMD_MANIFEST_NODE_FOR_COMMIT, commit1.toString());
+  EXPECT_THROW_RE(
+      helper.request(CMD_GET_TREE, rootNode),
+      HgImportPyError,
+      "treemanifest not enabled in this repository");
+}
+
 int main(int argc, char* argv[]) {
   testing::InitGoogleTest(&argc, argv);
   folly::init(&argc, &argv);
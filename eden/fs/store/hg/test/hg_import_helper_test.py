@@ -0,0 +1,400 @@
+#!/usr/bin/env python2
+#
+# Copyright (c) 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import imp
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# hg_import_helper.py is a standalone script rather than a module in a
+# package, so load it from its path.
+helper = imp.load_source(
+    'hg_import_helper',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 'hg_import_helper.py'))
+
+
+def make_request(txn_id, command=None, flags=0, body=b''):
+    if command is None:
+        command = helper.CMD_CAT_FILE
+    return helper.Request(txn_id, command, flags, body)
+
+
+def decode_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset:offset + 1])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def decode_compact_manifest(data):
+    '''
+    Decode one chunk of the compact CMD_MANIFEST encoding into a list of
+    (path, rev_hash, flags) tuples.
+    '''
+    entries = []
+    prev_path = b''
+    offset = 0
+    while offset < len(data):
+        shared, offset = decode_varint(data, offset)
+        suffix_len, offset = decode_varint(data, offset)
+        path = prev_path[:shared] + data[offset:offset + suffix_len]
+        offset += suffix_len
+        flags = data[offset:offset + 1]
+        offset += 1
+        rev_hash = data[offset:offset + helper.SHA1_NUM_BYTES]
+        offset += helper.SHA1_NUM_BYTES
+        entries.append((path, rev_hash, b'' if flags == b'\0' else flags))
+        prev_path = path
+    return entries
+
+
+class RequestQueueTest(unittest.TestCase):
+    def test_interactive_requests_before_prefetch(self):
+        queue = helper.RequestQueue()
+        prefetch = make_request(1, flags=helper.FLAG_PREFETCH_PRIORITY)
+        first = make_request(2)
+        second = make_request(3)
+        queue.put(prefetch)
+        queue.put(first)
+        queue.put(second)
+
+        self.assertIs(first, queue.get())
+        self.assertIs(second, queue.get())
+        self.assertIs(prefetch, queue.get())
+
+    def test_background_tasks_after_requests(self):
+        queue = helper.RequestQueue(max_active_background_tasks=1)
+        self.assertTrue(queue.accepts_background())
+        task1 = helper.BackgroundTask('task1', None)
+        task2 = helper.BackgroundTask('task2', None)
+        self.assertTrue(queue.put_background(task1))
+        self.assertTrue(queue.put_background(task2))
+        # The same work is only queued once.
+        self.assertTrue(
+            queue.put_background(helper.BackgroundTask('task1', None)))
+        request = make_request(1, flags=helper.FLAG_PREFETCH_PRIORITY)
+        queue.put(request)
+
+        self.assertIs(request, queue.get())
+        self.assertIs(task1, queue.get())
+        # task2 may not start until task1 is done, so this returns a request
+        # queued in the meantime.
+        request = make_request(2)
+        queue.put(request)
+        self.assertIs(request, queue.get())
+        queue.background_task_done()
+        self.assertIs(task2, queue.get())
+
+    def test_background_queue_limit(self):
+        queue = helper.RequestQueue(max_background_tasks=1,
+                                    max_active_background_tasks=1)
+        self.assertTrue(
+            queue.put_background(helper.BackgroundTask('task1', None)))
+        self.assertFalse(
+            queue.put_background(helper.BackgroundTask('task2', None)))
+
+    def test_no_background_tasks_by_default(self):
+        self.assertFalse(helper.RequestQueue().accepts_background())
+
+    def test_cancel(self):
+        queue = helper.RequestQueue()
+        first = make_request(1)
+        second = make_request(2, flags=helper.FLAG_PREFETCH_PRIORITY)
+        third = make_request(3)
+        for request in (first, second, third):
+            queue.put(request)
+
+        self.assertIs(second, queue.cancel(2))
+        self.assertIs(first, queue.cancel(1))
+        self.assertIsNone(queue.cancel(1))
+        self.assertIsNone(queue.cancel(4))
+        self.assertIs(third, queue.get())
+
+    def test_close(self):
+        queue = helper.RequestQueue(max_active_background_tasks=1)
+        request = make_request(1)
+        queue.put(request)
+        queue.put_background(helper.BackgroundTask('task', None))
+        queue.close()
+
+        # Queued requests are still handed out, but background tasks are
+        # discarded.
+        self.assertIs(request, queue.get())
+        self.assertIsNone(queue.get())
+
+
+class RequestCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = helper.RequestCoalescer(
+            (helper.CMD_CAT_FILE,), max_response_bytes=10)
+
+    def test_identical_requests(self):
+        first = make_request(1, body=b'file')
+        second = make_request(2, body=b'file')
+        third = make_request(3, flags=helper.FLAG_PREFETCH_PRIORITY,
+                             body=b'file')
+        other = make_request(4, body=b'other')
+
+        self.assertTrue(self.coalescer.start(first))
+        self.assertFalse(self.coalescer.start(second))
+        self.assertFalse(self.coalescer.start(third))
+        self.assertTrue(self.coalescer.start(other))
+
+        first.record_chunk(0, b'abcd')
+        self.assertEqual([second, third],
+                         self.coalescer.finish(first, 'cat_file'))
+        self.assertEqual([], self.coalescer.finish(other, 'cat_file'))
+        self.assertEqual([('coalesce.cat_file.requests', 2),
+                          ('coalesce.cat_file.bytes_saved', 8)],
+                         self.coalescer.get_counters())
+
+        # Once finished, the next identical request is processed again.
+        self.assertTrue(self.coalescer.start(make_request(5, body=b'file')))
+
+    def test_large_response(self):
+        first = make_request(1, body=b'file')
+        second = make_request(2, body=b'file')
+        self.assertTrue(self.coalescer.start(first))
+        self.assertFalse(self.coalescer.start(second))
+
+        first.record_chunk(0, b'x' * 11)
+        self.assertIsNone(first.recorded_chunks)
+        self.assertEqual([second], self.coalescer.finish(first, 'cat_file'))
+        self.assertEqual([], self.coalescer.get_counters())
+
+    def test_other_commands(self):
+        first = make_request(1, command=helper.CMD_MANIFEST, body=b'rev')
+        second = make_request(2, command=helper.CMD_MANIFEST, body=b'rev')
+        self.assertTrue(self.coalescer.start(first))
+        self.assertTrue(self.coalescer.start(second))
+        self.assertEqual([], self.coalescer.finish(first, 'manifest'))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def entry_size(self, key, value):
+        return len(key) + len(value) + helper.LRU_CACHE_ENTRY_OVERHEAD
+
+    def test_eviction(self):
+        entry_size = self.entry_size(b'a', b'aaaa')
+        cache = helper.LRUCache('test', max_bytes=3 * entry_size - 1)
+        cache.put(b'a', b'aaaa')
+        cache.put(b'b', b'bbbb')
+        # Reading 'a' makes 'b' the least recently used entry.
+        self.assertEqual(b'aaaa', cache.get(b'a'))
+        cache.put(b'c', b'cccc')
+
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(b'aaaa', cache.get(b'a'))
+        self.assertEqual(b'cccc', cache.get(b'c'))
+        counters = dict(cache.get_counters())
+        self.assertEqual(3, counters['test.hits'])
+        self.assertEqual(1, counters['test.misses'])
+        self.assertEqual(1, counters['test.evictions'])
+        self.assertEqual(2, counters['test.entries'])
+        self.assertEqual(2 * entry_size, counters['test.bytes'])
+
+    def test_entry_overhead(self):
+        # Small values are charged for far more than their length.
+        key = b'\x01' * 20
+        value = b'x' * 28
+        cache = helper.LRUCache('test',
+                                max_bytes=10 * self.entry_size(key, value))
+        for n in range(100):
+            cache.put(b'%020d' % n, value)
+        self.assertEqual(10, dict(cache.get_counters())['test.entries'])
+
+    def test_replace(self):
+        cache = helper.LRUCache('test', max_bytes=1000)
+        cache.put(b'a', b'aaaa')
+        cache.put(b'a', b'aa')
+        self.assertEqual(b'aa', cache.get(b'a'))
+        self.assertEqual(self.entry_size(b'a', b'aa'),
+                         dict(cache.get_counters())['test.bytes'])
+
+    def test_max_value_bytes(self):
+        cache = helper.LRUCache('test', max_bytes=1000, max_value_bytes=4)
+        cache.put(b'a', b'aaaaa')
+        cache.put(b'b', b'bbbb')
+        self.assertIsNone(cache.get(b'a'))
+        self.assertEqual(b'bbbb', cache.get(b'b'))
+
+    def test_disabled(self):
+        cache = helper.LRUCache('test', max_bytes=0)
+        cache.put(b'a', b'')
+        self.assertIsNone(cache.get(b'a'))
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def test_check(self):
+        cache = helper.NegativeCache('neg', ttl=60, max_entries=10)
+        error = KeyError('missing')
+        cache.add('key', 'sig1', error)
+
+        with self.assertRaises(KeyError) as ctx:
+            cache.check('key', lambda: 'sig1')
+        self.assertIs(error, ctx.exception)
+        cache.check('other', lambda: 'sig1')
+        self.assertEqual([('neg.hits', 1), ('neg.insertions', 1),
+                          ('neg.entries', 1)], cache.get_counters())
+
+    def test_signature_change(self):
+        cache = helper.NegativeCache('neg', ttl=60, max_entries=10)
+        cache.add('key', 'sig1', KeyError('missing'))
+        cache.check('key', lambda: 'sig2')
+        # The stale entry is removed.
+        cache.check('key', lambda: 'sig1')
+        self.assertEqual(0, dict(cache.get_counters())['neg.entries'])
+
+    def test_expiry(self):
+        cache = helper.NegativeCache('neg', ttl=0.05, max_entries=10)
+        cache.add('key', 'sig', KeyError('missing'))
+        time.sleep(0.1)
+        cache.check('key', lambda: 'sig')
+
+    def test_max_entries(self):
+        cache = helper.NegativeCache('neg', ttl=60, max_entries=2)
+        for key in ('a', 'b', 'c'):
+            cache.add(key, 'sig', KeyError(key))
+
+        cache.check('a', lambda: 'sig')
+        for key in ('b', 'c'):
+            with self.assertRaises(KeyError):
+                cache.check(key, lambda: 'sig')
+
+    def test_disabled(self):
+        cache = helper.NegativeCache('neg', ttl=0, max_entries=10)
+        cache.add('key', 'sig', KeyError('missing'))
+        cache.check('key', lambda: 'sig')
+
+
+class CompactManifestEncoderTest(unittest.TestCase):
+    def test_encode_varint(self):
+        for value in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2 ** 32):
+            data = helper.encode_varint(value)
+            self.assertEqual((value, len(data)), decode_varint(data, 0))
+        self.assertEqual(b'\x7f', helper.encode_varint(0x7f))
+        self.assertEqual(b'\x80\x01', helper.encode_varint(0x80))
+
+    def test_round_trip(self):
+        entries = [
+            (b'README', b'\x01' * 20, b''),
+            (b'src/a.py', b'\x02' * 20, b'x'),
+            (b'src/ab.py', b'\x03' * 20, b''),
+            (b'src/b', b'\x04' * 20, b'l'),
+            (b'src/' + b'd' * 200 + b'/file', b'\x05' * 20, b''),
+            (b'src/' + b'd' * 200 + b'/file2', b'\x00' * 20, b''),
+            (b'zzz', b'\x06' * 20, b''),
+        ]
+        encoder = helper.CompactManifestEncoder()
+        data = b''.join(encoder.encode(entry) for entry in entries)
+        self.assertEqual(entries, decode_compact_manifest(data))
+        # Shared prefixes are not repeated.
+        self.assertLess(len(data), sum(len(path) + 22
+                                       for path, _, _ in entries))
+
+    def test_reset(self):
+        encoder = helper.CompactManifestEncoder()
+        first = (b'dir/a', b'\x01' * 20, b'')
+        second = (b'dir/b', b'\x02' * 20, b'')
+        encoder.encode(first)
+        encoder.reset()
+        # After a reset each chunk can be decoded on its own.
+        self.assertEqual([second],
+                         decode_compact_manifest(encoder.encode(second)))
+
+
+class WriteAllTest(unittest.TestCase):
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.orig_writev = helper._writev
+
+    def tearDown(self):
+        helper._writev = self.orig_writev
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def check_write_all(self, buffers):
+        helper.write_all(self.write_fd, buffers)
+        expected = b''.join(buffers)
+        self.assertEqual(expected,
+                         helper.read_exact(self.read_fd, len(expected)))
+
+    def test_full_write(self):
+        self.check_write_all([b'header', b'', b'body'])
+
+    def test_short_writes(self):
+        for limit in (0, 1, 6, 7, 9):
+            def short_writev(fd, buffers):
+                return os.write(fd, b''.join(buffers)[:limit])
+            helper._writev = short_writev
+            self.check_write_all([b'header', b'', b'body'])
+
+    def test_no_writev(self):
+        helper._writev = None
+        self.check_write_all([b'header', b'body'])
+
+
+class ReadTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='hg_import_helper_test')
+        self.path = os.path.join(self.tmp_dir, 'trace')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        recorder = helper.TraceRecorder(self.path)
+        first = make_request(1, body=b'\x01' * 20 + b'path')
+        first.bytes_sent = 100
+        second = make_request(2, command=helper.CMD_MANIFEST,
+                              flags=helper.FLAG_PREFETCH_PRIORITY)
+        recorder.record(first, 0.5)
+        recorder.record(second, 0.001)
+
+        records = helper.read_trace(self.path)
+        self.assertEqual(2, len(records))
+        self.assertEqual((1, helper.CMD_CAT_FILE, 0, first.body, 100, 500000),
+                         (records[0].txn_id, records[0].command,
+                          records[0].flags, records[0].body,
+                          records[0].bytes_sent, records[0].latency_us))
+        self.assertEqual((2, helper.CMD_MANIFEST,
+                          helper.FLAG_PREFETCH_PRIORITY, b'', 0, 1000),
+                         (records[1].txn_id, records[1].command,
+                          records[1].flags, records[1].body,
+                          records[1].bytes_sent, records[1].latency_us))
+        self.assertLessEqual(records[0].received_us, records[1].received_us)
+
+    def test_truncated(self):
+        recorder = helper.TraceRecorder(self.path)
+        recorder.record(make_request(1, body=b'body'), 0)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        for length in (helper.TRACE_RECORD_SIZE - 1, len(data) - 1):
+            with open(self.path, 'wb') as f:
+                f.write(data[:length])
+            with self.assertRaises(Exception):
+                helper.read_trace(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()